@@ -21,6 +21,7 @@ from pdpbox import pdp
 from rfpimp import *
 from scipy.integrate import cumtrapz
 from stratx.partdep import *
+from dtreeviz.trees import rtreeviz_univar
 from stratx.ice import *
 import inspect
 import statsmodels.api as sm
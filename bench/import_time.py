@@ -0,0 +1,66 @@
+"""
+Guard against import-time regressions: time `import stratx.partdep` and
+`import stratx.ice` in fresh interpreters and fail if either drags in a
+heavy dependency (sklearn, scipy.stats, matplotlib, ...) before first use
+or costs more than --budget seconds on top of numpy and pandas, which
+stratx can't do without.
+
+    python bench/import_time.py [--repeat 5] [--budget 0.2]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+# Must only load when a function that needs them is called
+LAZY = ['sklearn', 'scipy.stats', 'scipy.sparse', 'matplotlib', 'dtreeviz']
+
+PROBE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+print(' '.join(m for m in {lazy!r} if m in sys.modules))
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def cold_import(module:str):
+    "Seconds to import module in a fresh interpreter and the LAZY modules it loaded"
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    out = subprocess.run([sys.executable, '-c', PROBE.format(module=module, lazy=LAZY)],
+                         capture_output=True, text=True, check=True, env=env).stdout.splitlines()
+    return float(out[0]), out[1].split() if len(out) > 1 else []
+
+
+def median_import(module:str, repeat:int):
+    runs = [cold_import(module) for _ in range(repeat)]
+    return sorted(t for t, _ in runs)[repeat // 2], runs[-1][1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=0.2,
+                        help="max seconds over the numpy+pandas baseline")
+    args = parser.parse_args()
+
+    baseline, _ = median_import('numpy, pandas', args.repeat)
+    print(f"{'numpy, pandas':16s} {baseline:.3f}s (baseline)")
+    failed = False
+    for module in ['stratx.partdep', 'stratx.ice']:
+        t, loaded = median_import(module, args.repeat)
+        over = t - baseline
+        problems = []
+        if loaded:
+            problems.append(f"eagerly imports {', '.join(loaded)}")
+        if over > args.budget:
+            problems.append(f"over budget by {over - args.budget:.3f}s")
+        print(f"{module:16s} {t:.3f}s (+{over:.3f}s) {'; '.join(problems) or 'ok'}")
+        failed |= len(problems) > 0
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 from sklearn.datasets import load_boston, load_diabetes
 from stratx.partdep import *
+import matplotlib.pyplot as plt
 
 boston = load_boston()
 df = pd.DataFrame(boston.data, columns=boston.feature_names)
@@ -10,7 +10,7 @@ setup(
     python_requires='>=3.6',
     author='Terence Parr',
     author_email='parrt@antlr.org',
-    install_requires=['sklearn','pandas','numpy','matplotlib','scipy','dtreeviz'],
+    install_requires=['scikit-learn','pandas','numpy','matplotlib','scipy'],
     description='Model-independent partial dependence plots in Python 3 that works even for codependent variables',
     keywords='model-independent net-effect plots, visualization, partial dependence plots, partial derivative plots, ICE plots, feature importance',
     classifiers=['License :: OSI Approved :: MIT License',
@@ -1,39 +1,69 @@
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from  matplotlib.collections import LineCollection
 import time
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 """
 This code was built just to generate ICE plots for comparison in the paper.
 We just hacked it together.
 """
 
-from stratx.partdep import getcats
+ICE_CHUNK_ROWS = 8192 # most rows predict_ice() hands a single predict() or thread
+ICE_RASTER_LINES = 10_000 # plot_ice(raster='auto') draws a density image above this many lines
 
-def predict_catice(model, X:pd.DataFrame, colname:str, targetname, cats=None, ncats=None):
+def predict_catice(model, X:pd.DataFrame, colname:str, targetname, cats=None, ncats=None, engine='auto',
+                   n_jobs=None):
     if cats is None:
         cats = np.unique(X[colname]) # get unique codes
     return predict_ice(model=model, X=X, colname=colname, targetname=targetname,
-                       cats=cats, nlines=ncats)
+                       cats=cats, nlines=ncats, engine=engine, n_jobs=n_jobs)
 
 
-def predict_ice(model, X:pd.DataFrame, colname:str, targetname="target", cats=None, numx=50, nlines=None):
+def predict_ice(model, X:pd.DataFrame, colname:str, targetname="target", cats=None, numx=50, nlines=None,
+                engine='auto', max_bytes=256 * 1024**2, random_state=None, n_jobs=None,
+                out=None) -> np.ndarray:
     """
-    Return dataframe with one row per observation in X and one column
-    per unique value of column identified by colname.
-    Row 0 is actually the sorted unique X[colname] values used to get predictions.
-    It's handy to have so we don't have to pass X around to other methods.
-    Points in a single ICE line are the unique values of colname zipped
-    with one row of returned dataframe. E.g.,
-
-    	predicted weight          predicted weight         ...
-    	height=62.3638789416112	  height=62.78667197542318 ...
-    0	62.786672	              70.595222                ... unique X[colname] values
-    1	109.270644	              161.270843               ...
+    Return a matrix with one row per ICE line and one column per grid value
+    of colname: the sorted unique cats if given, else numx evenly spaced
+    values across X[colname] (or all unique values if numx is None).
+    Row 0 is the grid itself, so we don't have to pass X around to other
+    methods; row i+1 is the model's prediction for observation i with
+    X[colname] set to each grid value in turn. E.g.,
+
+        62.786672   70.595222   ...   grid (X[colname] values)
+        109.270644  161.270843  ...   observation 0
+        ...
+
+    With nlines, that many observations are sampled (without replacement,
+    using random_state) before predicting anything, rather than predicting
+    all of X and throwing most of it away. Predictions are made a chunk of
+    rows at a time: the chunk is stacked once per grid value with colname
+    replaced and passed to a single model.predict(), with chunks sized so
+    the stacked frame stays within max_bytes. X itself is never modified,
+    so it's safe to share X between threads or concurrent calls.
+
+    With n_jobs > 1 (-1 means all cores) chunks are predicted on a pool of
+    threads; sklearn predictors do most of their work without the GIL.
+    Chunk boundaries depend only on X and max_bytes, never on n_jobs, and
+    each chunk fills its own rows, so the result is identical for any n_jobs.
+
+    For ICE over more rows than fit in memory, pass out='ice.npy': rows are
+    written straight into that .npy file as chunks are predicted and the
+    result is a read-only np.memmap over it, which pages rows in on demand.
+    Reopen it later with np.load('ice.npy', mmap_mode='r'). ice_pdp(),
+    plot_ice() and plot_catice() read such a matrix a block of rows at a
+    time, so their memory use doesn't grow with the number of rows.
+
+    engine='auto' uses tree_ice() when model is a fitted sklearn tree or
+    forest regressor and the stacked predict() otherwise; 'tree' or
+    'predict' forces one or the other. targetname is no longer used.
+
+    Emits an 'ice_predict' profiling event; see stratx.partdep.profiling().
     """
-    start = time.time()
-    save = X[colname].copy()
+    from stratx.partdep import emit, in_context
+
+    start = time.perf_counter()
 
     if nlines is not None and nlines > len(X):
         nlines = len(X)
@@ -44,32 +74,212 @@ def predict_ice(model, X:pd.DataFrame, colname:str, targetname="target", cats=No
     elif numx is not None:
         linex = np.linspace(np.min(X[colname]), np.max(X[colname]), numx, endpoint=True)
     else:
-        linex = sorted(X[colname].unique())
+        linex = np.array(sorted(X[colname].unique()))
 
-    lines = np.zeros(shape=(len(X) + 1, len(linex)))
+    if nlines is not None:
+        rng = np.random.default_rng(random_state)
+        X = X.iloc[np.sort(rng.choice(len(X), size=nlines, replace=False))]
+
+    shape = (len(X) + 1, len(linex))
+    if out is None:
+        lines = np.empty(shape=shape)
+    else:
+        lines = np.lib.format.open_memmap(out, mode='w+', dtype=np.float64, shape=shape)
     lines[0, :] = linex
-    i = 0
-    for v in linex:
-        X[colname] = v
-        y_pred = model.predict(X)
-        lines[1:, i] = y_pred
-        i += 1
-    X[colname] = save
-    columns = [f"predicted {targetname}\n{colname}={str(v)}"
-               for v in linex]
-    df = pd.DataFrame(lines, columns=columns)
+    row_bytes = max(1, X.memory_usage(index=False).sum() / max(1, len(X)))
+    chunksize = max(1, min(ICE_CHUNK_ROWS, int(max_bytes // (row_bytes * len(linex)))))
+
+    def predict_chunk(i):
+        chunk = X.iloc[i:i+chunksize]
+        ice = tree_ice(model, chunk, colname, linex) if engine in ('auto', 'tree') else None
+        if ice is None:
+            if engine == 'tree':
+                raise ValueError("engine='tree' needs a fitted sklearn tree or forest regressor and no missing values")
+            ice = stacked_ice(model, chunk, colname, linex)
+        lines[1+i:1+i+len(chunk), :] = ice
+
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    starts = range(0, len(X), chunksize)
+    if n_jobs is None or n_jobs <= 1:
+        for i in starts:
+            predict_chunk(i)
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            list(pool.map(in_context(predict_chunk), starts)) # list() re-raises any chunk's exception
+
+    if out is not None:
+        lines.flush()
+        del lines
+        lines = np.load(out, mmap_mode='r')
+
+    emit('ice_predict', time.perf_counter() - start, colname=colname, rows=len(X), x=len(linex),
+         chunks=len(starts), nbytes=int(row_bytes * len(linex) * min(chunksize, len(X))))
+    return lines
+
+
+def stacked_ice(model, X:pd.DataFrame, colname:str, linex) -> np.ndarray:
+    """
+    ICE matrix of any model for the rows of X with one model.predict() call
+    on len(linex) copies of X stacked vertically, copy j having X[colname]
+    set to linex[j]. Returns a len(X) x len(linex) matrix.
+    """
+    n = len(X)
+    stacked = X.iloc[np.tile(np.arange(n), len(linex))]
+    stacked[colname] = np.repeat(linex, n)
+    return np.asarray(model.predict(stacked)).reshape(len(linex), n).T
+
+
+def tree_ice(model, X:pd.DataFrame, colname:str, linex) -> np.ndarray:
+    """
+    Return the len(X) x len(linex) ICE matrix, model's prediction for each
+    row of X with X[colname] set to each linex value, read straight off
+    the trees of a fitted sklearn DecisionTreeRegressor, RandomForestRegressor
+    or ExtraTreesRegressor. Returns None for any other model, if X has
+    missing values, or if X doesn't have the columns the model was fit on
+    in the same order, so the caller can fall back on model.predict()
+    (which raises on mismatched columns rather than guessing).
+
+    A tree's prediction as a function of colname alone is piecewise
+    constant between the thresholds of the nodes that split on colname, so
+    grid values between the same two thresholds share a prediction. Each
+    tree is evaluated one of two ways, whichever looks cheaper:
+
+    walk: push all rows through the tree in lockstep, each carrying the
+    range of grid values still to be resolved. A row follows its own
+    values at nodes splitting on other columns and is cut in two at
+    nodes splitting on colname, so it only branches where colname matters
+    for that row.
+
+    apply: one tree apply() per run of grid values between thresholds
+    rather than one per grid value.
+
+    The walk is estimated on a few rows first. Leaf values go into a
+    difference array over the grid. As in sklearn, features are compared
+    as float32 so results match model.predict() up to float rounding.
+    """
+    from sklearn.tree import DecisionTreeRegressor
+    from sklearn.ensemble import RandomForestRegressor, ExtraTreesRegressor
+
+    if isinstance(model, DecisionTreeRegressor) and hasattr(model, 'tree_'):
+        trees = [model]
+    elif isinstance(model, (RandomForestRegressor, ExtraTreesRegressor)) and hasattr(model, 'estimators_'):
+        trees = model.estimators_
+    else:
+        return None
+    if model.n_outputs_ != 1:
+        return None
+    if X.shape[1] != model.n_features_in_ or \
+            (hasattr(model, 'feature_names_in_') and list(model.feature_names_in_) != list(X.columns)):
+        return None
+    X32 = np.ascontiguousarray(X.to_numpy(dtype=np.float32))
+    if np.isnan(X32).any():
+        return None
+    c = X.columns.get_loc(colname)
+    linex = np.asarray(linex)
+    order = np.argsort(linex, kind='stable')
+    gridx = linex[order].astype(np.float32).astype(np.float64)
+
+    numx = len(gridx)
+    diffs = np.zeros((len(X), numx + 1))
+    flat = diffs.reshape(-1)
+    probe = X32[::max(1, len(X32) // 256)]
+    for t in trees:
+        tree = t.tree_
+        cthresholds = np.unique(tree.threshold[tree.feature == c])
+        runs = np.searchsorted(cthresholds, gridx, side='left') # same for grid values between thresholds
+        run_starts = np.flatnonzero(np.diff(runs, prepend=-1))
+        # Measured on forests, a walk costs about as much per row step as
+        # half an apply() of the whole tree; so walk if there are fewer
+        # row steps than runs, erring on the side of the compiled apply()
+        walk_steps = _tree_ice_walk(tree, probe, c, gridx) / len(probe)
+        if walk_steps < len(run_starts):
+            _tree_ice_walk(tree, X32, c, gridx, flat, numx + 1, 1.0 / len(trees))
+        else:
+            _tree_ice_apply(tree, X32, c, gridx, run_starts, diffs, 1.0 / len(trees))
+    ice = np.cumsum(diffs, axis=1)[:, :numx]
+    result = np.empty_like(ice)
+    result[:, order] = ice
+    return result
+
+
+def _tree_ice_walk(tree, X32, c, gridx, flat_diffs=None, stride=0, weight=1.0) -> int:
+    """
+    Add weight * tree's ICE values for all rows of X32 into flat_diffs; see
+    tree_ice(). Returns the total number of row steps taken, which is all
+    it computes if flat_diffs is None.
+    """
+    left, right = tree.children_left, tree.children_right
+    feature, threshold = tree.feature, tree.threshold
+    value = tree.value[:, 0, 0] * weight
+    isleaf = left == -1
+    row = np.arange(len(X32))
+    node = np.zeros(len(X32), dtype=np.intp)
+    lo = np.zeros(len(X32), dtype=np.intp)
+    hi = np.full(len(X32), len(gridx), dtype=np.intp)
+    steps = 0
+    while len(node) > 0:
+        steps += len(node)
+        done = isleaf[node]
+        if done.any():
+            if flat_diffs is not None:
+                base = row[done] * stride
+                v = value[node[done]]
+                np.add.at(flat_diffs, base + lo[done], v)
+                np.add.at(flat_diffs, base + hi[done], -v)
+            active = ~done
+            row, node, lo, hi = row[active], node[active], lo[active], hi[active]
+        f = feature[node]
+        th = threshold[node]
+        onc = f == c
+        step = np.where(X32[row, f] <= th, left[node], right[node])
+        if not onc.any():
+            node = step
+            continue
+        # at colname splits, grid values <= threshold go left, the rest go right
+        other = ~onc
+        crow, cnode, clo, chi = row[onc], node[onc], lo[onc], hi[onc]
+        k = np.searchsorted(gridx, th[onc], side='right')
+        lhi, rlo = np.minimum(chi, k), np.maximum(clo, k)
+        lpart, rpart = clo < lhi, rlo < chi
+        row = np.concatenate([row[other], crow[lpart], crow[rpart]])
+        node = np.concatenate([step[other], left[cnode[lpart]], right[cnode[rpart]]])
+        lo = np.concatenate([lo[other], clo[lpart], rlo[rpart]])
+        hi = np.concatenate([hi[other], lhi[lpart], chi[rpart]])
+    return steps
+
+
+def _tree_ice_apply(tree, X32, c, gridx, run_starts, diffs, weight):
+    "Add weight * tree's ICE values into diffs with one apply() per run of grid values; see tree_ice()"
+    value = tree.value[:, 0, 0] * weight
+    run_ends = np.append(run_starts[1:], len(gridx))
+    Xc = X32.copy()
+    for start, end in zip(run_starts, run_ends):
+        Xc[:, c] = gridx[start]
+        v = value[tree.apply(Xc)]
+        diffs[:, start] += v
+        diffs[:, end] -= v
+
+
+def ice_blocks(ice:np.ndarray, blocksize=ICE_CHUNK_ROWS):
+    """
+    Yield the ICE lines of ice (rows 1 on; row 0 is the grid) blocksize rows
+    at a time as in-memory arrays, so a memmap'd ice is read piece by piece.
+    """
+    for i in range(1, len(ice), blocksize):
+        yield np.asarray(ice[i:i+blocksize])
 
-    if nlines is not None:
-        # sample lines (first row is special: linex)
-        df_ = pd.DataFrame(lines)
-        df_ = df_.sample(n=nlines, axis=0, replace=False)
-        lines = df_.values
-        lines = np.concatenate([linex.reshape(1,-1),lines], axis=0)
-        df = pd.DataFrame(lines, columns=columns)
 
-    stop = time.time()
-    print(f"ICE_predict {stop - start:.3f}s")
-    return df
+def ice_pdp(ice:np.ndarray) -> np.ndarray:
+    """
+    Return the PD curve, the mean of ice's ICE lines at each grid value,
+    accumulated a block of rows at a time; see ice_blocks().
+    """
+    ice = np.asarray(ice)
+    total = np.zeros(ice.shape[1])
+    for block in ice_blocks(ice):
+        total += block.sum(axis=0)
+    return total / (len(ice) - 1)
 
 
 def ice2lines(ice:np.ndarray) -> np.ndarray:
@@ -79,44 +289,103 @@ def ice2lines(ice:np.ndarray) -> np.ndarray:
     in a single ICE line for single observations. Shape of result is:
     (nobservations,nuniquevalues,2)
     """
-    start = time.time()
-    linex = ice.iloc[0,:] # get unique x values from first row
-    # If needed, apply_along_axis() is faster than the loop
-    # def getline(liney): return np.array(list(zip(linex, liney)))
-    # lines = np.apply_along_axis(getline, axis=1, arr=ice.iloc[1:])
-    lines = []
-    for i in range(1,len(ice)): # ignore first row
-        liney = ice.iloc[i].values
-        line = np.array(list(zip(linex, liney)))
-        lines.append(line)
-    stop = time.time()
-    # print(f"ICE_lines {stop - start:.3f}s")
-    return np.array(lines)
+    ice = np.asarray(ice)
+    liney = ice[1:] # ignore first row
+    return np.stack([np.broadcast_to(ice[0], liney.shape), liney], axis=-1)
+
+
+def ice_density(ice:np.ndarray, bins=(400, 300), yrange=None):
+    """
+    Rasterize the ICE lines of ice into a bins[1] x bins[0] (y by x) matrix
+    counting how many lines pass through each pixel, for drawing with
+    imshow(origin='lower'). Each line is sampled at every pixel column's
+    center by interpolating linearly between grid values, all lines at once.
+    Rows are read a block at a time (see ice_blocks()), twice if yrange is
+    None since the y range has to be found first. Returns the matrix and
+    its extent (minx, maxx, miny, maxy).
+    """
+    ice = np.asarray(ice)
+    linex = np.array(ice[0])
+    nxbins, nybins = bins
+    minx, maxx = linex[0], linex[-1]
+    if yrange is None:
+        miny = min(np.min(block) for block in ice_blocks(ice))
+        maxy = max(np.max(block) for block in ice_blocks(ice))
+    else:
+        miny, maxy = yrange
+    if maxy == miny:
+        maxy = miny + 1
+
+    centers = minx + (np.arange(nxbins) + 0.5) * (maxx - minx) / nxbins
+    j = np.clip(np.searchsorted(linex, centers, side='right') - 1, 0, max(len(linex) - 2, 0))
+    k = np.minimum(j + 1, len(linex) - 1)
+    dx = linex[k] - linex[j]
+    t = np.divide(centers - linex[j], dx, out=np.zeros(nxbins), where=dx > 0).astype(np.float32)
+
+    density = np.zeros(nybins * nxbins, dtype=np.int64)
+    cols = np.arange(nxbins, dtype=np.float32)
+    for block in ice_blocks(ice):
+        # scale to pixel rows on the small grid first, then interpolate
+        block = ((block - miny) * (nybins / (maxy - miny))).astype(np.float32)
+        rows = block[:, j] * (1 - t) + block[:, k] * t
+        inside = (rows >= 0) & (rows <= nybins)
+        rows = np.minimum(rows, np.float32(nybins - 1)) # y == maxy goes in the top row
+        density += np.bincount((np.floor(rows) * nxbins + cols)[inside].astype(np.int64),
+                               minlength=nybins * nxbins)
+    return density.reshape(nybins, nxbins), (minx, maxx, miny, maxy)
 
 
 def plot_ice(ice, colname, targetname="target", ax=None, linewidth=.5, linecolor='#9CD1E3',
              alpha=.1, title=None, xrange=None, yrange=None, pdp=True, pdp_linewidth=.5, pdp_alpha=1,
-             pdp_color='black', show_xlabel=True, show_ylabel=True):
-    start = time.time()
+             pdp_color='black', show_xlabel=True, show_ylabel=True, raster='auto', raster_bins=(400, 300)):
+    """
+    Plot the ICE lines of predict_ice() matrix ice, shifted so the PD curve
+    starts at (or passes through x=0 at) y=0, plus the PD curve if pdp.
+    With raster=True, the lines are drawn as one density image of
+    raster_bins pixels (see ice_density()) rather than one vector line
+    each, which keeps rendering time and SVG/PDF size flat no matter how
+    many lines there are. raster='auto' does that above ICE_RASTER_LINES
+    lines. Returns the grid and the shifted PD curve.
+    """
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import LineCollection
+    from matplotlib.colors import LinearSegmentedColormap, to_rgba
+    from stratx.partdep import emit
+
+    start = time.perf_counter()
     if ax is None:
         fig, ax = plt.subplots(1,1)
 
-    avg_y = np.mean(ice[1:], axis=0)
+    ice = np.asarray(ice) # predict_ice() matrix, memmap or, from older versions, DataFrame
+    avg_y = ice_pdp(ice)
 
     min_pdp_y = avg_y[0]
     # if 0 is in x feature and not on left/right edge, get y at 0
     # and shift so that is x,y 0 point.
-    linex = ice.iloc[0,:] # get unique x values from first row
+    linex = np.array(ice[0]) # get unique x values from first row
     nx = len(linex)
     if linex[int(nx*0.05)]<0 or linex[-int(nx*0.05)]>0:
         closest_x_to_0 = np.abs(linex - 0.0).argmin()
         min_pdp_y = avg_y[closest_x_to_0]
 
-    lines = ice2lines(ice)
-    lines[:,:,1] = lines[:,:,1] - min_pdp_y
-    # lines[:,:,0] scans all lines, all points in a line, and gets x column
-    minx, maxx = np.min(lines[:,:,0]), np.max(lines[:,:,0])
-    miny, maxy = np.min(lines[:,:,1]), np.max(lines[:,:,1])
+    minx, maxx = np.min(linex), np.max(linex)
+    if raster == 'auto':
+        raster = len(ice) - 1 > ICE_RASTER_LINES
+    if raster:
+        shifted_yrange = None if yrange is None else (yrange[0] + min_pdp_y, yrange[1] + min_pdp_y)
+        density, (_, _, miny, maxy) = ice_density(ice, bins=raster_bins, yrange=shifted_yrange)
+        miny, maxy = miny - min_pdp_y, maxy - min_pdp_y
+        cmap = LinearSegmentedColormap.from_list('ice', [to_rgba(linecolor, 0), to_rgba(linecolor, 1)])
+        ax.imshow(np.log1p(density), origin='lower', extent=(minx, maxx, miny, maxy),
+                  aspect='auto', interpolation='nearest', cmap=cmap)
+    else:
+        # draw a block of lines at a time so a memmap'd ice is never in memory whole
+        miny, maxy = np.inf, -np.inf
+        for block in ice_blocks(ice):
+            lines = ice2lines(np.concatenate([linex.reshape(1,-1), block]))
+            lines[:,:,1] = lines[:,:,1] - min_pdp_y
+            miny, maxy = min(miny, np.min(lines[:,:,1])), max(maxy, np.max(lines[:,:,1]))
+            ax.add_collection(LineCollection(lines, linewidth=linewidth, alpha=alpha, color=linecolor))
     if yrange is not None:
         ax.set_ylim(*yrange)
     else:
@@ -127,22 +396,19 @@ def plot_ice(ice, colname, targetname="target", ax=None, linewidth=.5, linecolor
         ax.set_ylabel(targetname)
     if title is not None:
         ax.set_title(title)
-    lines = LineCollection(lines, linewidth=linewidth, alpha=alpha, color=linecolor)
-    ax.add_collection(lines)
 
     if xrange is not None:
         ax.set_xlim(*xrange)
     else:
         ax.set_xlim(minx, maxx)
 
-    uniq_x = ice.iloc[0, :]
+    uniq_x = linex
     pdp_curve = avg_y - min_pdp_y
     if pdp:
         ax.plot(uniq_x, pdp_curve,
                 alpha=pdp_alpha, linewidth=pdp_linewidth, c=pdp_color)
 
-    stop = time.time()
-    # print(f"plot_ICE {stop - start:.3f}s")
+    emit('render', time.perf_counter() - start, colname=colname, lines=len(ice) - 1, raster=bool(raster))
     return uniq_x, pdp_curve
 
 def plot_catice(ice, colname, targetname,
@@ -155,42 +421,52 @@ def plot_catice(ice, colname, targetname,
                 marker_size=10,
                 show_xlabel=True, show_ylabel=True,
                 show_xticks=True,
-                sort='ascending'):
-    start = time.time()
+                sort='ascending',
+                top_k=None, bottom_k=None):
+    """
+    Plot each observation's prediction per category of predict_catice()
+    matrix ice, shifted so the leftmost category's average is 0, plus the
+    per-category averages if pdp. With top_k and/or bottom_k, only the
+    categories with the top_k largest and bottom_k smallest averages are
+    drawn. Every block of rows (see ice_blocks()) is a single scatter.
+    """
+    import matplotlib.pyplot as plt
+    from stratx.partdep import getcats, extreme_cats, emit
+
+    start = time.perf_counter()
     if ax is None:
         fig, ax = plt.subplots(1,1)
 
     ncats = len(catnames)
 
-    avg_y = np.mean(ice[1:], axis=0)
-
-    lines = ice2lines(ice)
-
-    nobs = lines.shape[0]
-    nx = lines.shape[1]
+    ice = np.asarray(ice)
+    avg_y = ice_pdp(ice)
 
     catcodes, _, catcode2name = getcats(None, colname, catnames)
     sorted_catcodes = catcodes
+    sorted_indexes = np.arange(ncats)
     if sort == 'ascending':
         sorted_indexes = avg_y.argsort()
         sorted_catcodes = catcodes[sorted_indexes]
     elif sort == 'descending':
         sorted_indexes = avg_y.argsort()[::-1] # reversed
         sorted_catcodes = catcodes[sorted_indexes]
+    if top_k is not None or bottom_k is not None:
+        sorted_indexes = sorted_indexes[np.isin(sorted_indexes, extreme_cats(avg_y, top_k, bottom_k))]
+        sorted_catcodes = catcodes[sorted_indexes]
+    nshown = len(sorted_indexes)
 
     # find leftmost value (lowest value if sorted ascending) and shift by this
     min_pdp_y = avg_y[sorted_indexes[0]]
-    lines[:,:,1] = lines[:,:,1] - min_pdp_y
     pdp_curve = avg_y - min_pdp_y
 
     # plot predicted values for each category at each observation point
     if True in catnames or False in catnames:
-        xlocs = np.arange(0, ncats)
+        xlocs = np.arange(0, nshown)
     else:
-        xlocs = np.arange(1,ncats+1)
-    # print(f"shape {lines.shape}, ncats {ncats}, nx {nx}, len(pdp) {len(pdp_curve)}")
-    for i in range(nobs): # for each observation
-        ax.scatter(xlocs, lines[i,sorted_indexes,1], # lines[i] is ith observation
+        xlocs = np.arange(1,nshown+1)
+    for block in ice_blocks(ice): # all observations in block at once
+        ax.scatter(np.tile(xlocs, len(block)), (block[:, sorted_indexes] - min_pdp_y).ravel(),
                    alpha=alpha, marker='o', s=marker_size,
                    c=color)
 
@@ -209,7 +485,7 @@ def plot_catice(ice, colname, targetname,
     if True in catnames or False in catnames:
         ax.set_xticks(range(0, 1+1))
     else:
-        ax.set_xticks(range(1, ncats+1))
+        ax.set_xticks(range(1, nshown+1))
 
     if show_xticks: # sometimes too many
         ax.set_xticklabels(catcode2name[sorted_catcodes])
@@ -217,5 +493,4 @@ def plot_catice(ice, colname, targetname,
         ax.set_xticklabels([])
         ax.tick_params(axis='x', which='both', bottom=False)
 
-    stop = time.time()
-    print(f"plot_catice {stop - start:.3f}s")
\ No newline at end of file
+    emit('render', time.perf_counter() - start, colname=colname, lines=len(ice) - 1, cats=nshown)
\ No newline at end of file
@@ -1,236 +1,427 @@
 import numpy as np
 import pandas as pd
 from typing import Mapping, List, Tuple
-import matplotlib.pyplot as plt
-from  matplotlib.collections import LineCollection
-from sklearn.linear_model import LinearRegression
-from sklearn.ensemble import RandomForestRegressor
-from scipy.stats import binned_statistic
-import warnings
+import logging
+import contextvars
+import os
+import hashlib
+import tempfile
+import weakref
+import itertools
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import time
-from dtreeviz.trees import *
 
+SLOPE_RASTER_LINES = 50_000 # render_stratpd(raster='auto') draws slopes as a density image above this
 
-def leaf_samples(rf, X:np.ndarray):
+
+class LeafIndex:
+    """
+    Compressed sparse row (CSR) index of the X sample indexes residing in
+    each leaf of every tree in a forest. The sample indexes for leaf i are
+    samples[offsets[i]:offsets[i+1]]. Leaves are ordered by tree then by node
+    id and the sample indexes within a leaf are in increasing order, which is
+    the order the old per-tree groupby produced. keys[i] is the forest-wide
+    node id of leaf i: its node id within its tree plus the node count of all
+    previous trees.
+
+    Iterating yields one array (view) of sample indexes per leaf so code
+    written against the old list of arrays still works.
+    """
+    def __init__(self, samples:np.ndarray, offsets:np.ndarray, keys:np.ndarray):
+        self.samples = samples
+        self.offsets = offsets
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.samples[self.offsets[i]:self.offsets[i+1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def sizes(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def leaf_ids(self) -> np.ndarray:
+        "Return the leaf number (0..len(self)-1) of each entry in self.samples"
+        return np.repeat(np.arange(len(self)), self.sizes)
+
+
+def leaf_samples(rf, X:np.ndarray) -> LeafIndex:
     """
-    Return a list of arrays where each array is the set of X sample indexes
-    residing in a single leaf of some tree in rf forest.
+    Return a LeafIndex describing the set of X sample indexes residing in
+    each leaf of each tree in rf forest. Built in one pass: a stable argsort
+    of the forest-wide leaf id of every (tree, sample) pair groups samples
+    by leaf and a bincount over the same ids gives the leaf sizes.
     """
-    ntrees = len(rf.estimators_)
     leaf_ids = rf.apply(X) # which leaf does each X_i go to for each tree?
-    d = pd.DataFrame(leaf_ids, columns=[f"tree{i}" for i in range(ntrees)])
-    d = d.reset_index() # get 0..n-1 as column called index so we can do groupby
+    n, ntrees = leaf_ids.shape
+    # Tree-major: all n samples for tree0, then all n for tree1, etc...
+    keys = (leaf_ids + tree_offsets(rf)).T.ravel()
+    counts = np.bincount(keys, minlength=sum(t.tree_.node_count for t in rf.estimators_))
+    order = np.argsort(keys, kind='stable')
+    samples = (order % n).astype(np.int32)
+    leaf_keys = np.flatnonzero(counts)
+    offsets = np.concatenate([[0], np.cumsum(counts[leaf_keys])])
+    return LeafIndex(samples, offsets, leaf_keys)
+
+
+def tree_offsets(rf) -> np.ndarray:
+    "Node count of all previous trees for each tree; node id + offset is a forest-wide id"
+    node_counts = np.array([t.tree_.node_count for t in rf.estimators_])
+    return np.concatenate([[0], np.cumsum(node_counts)[:-1]])
+
+
+profile_log = logging.getLogger('stratx.profile')
+_profilers = contextvars.ContextVar('stratx_profilers', default=())
+
+
+@contextmanager
+def profiling(callback):
     """
-    d looks like:
-        index	tree0	tree1	tree2	tree3	tree4
-    0	0	    8	    3	    4	    4	    3
-    1	1	    8	    3	    4	    4	    3
+    Call callback(event) for every pipeline stage stratx runs inside the
+    with-block. event is a dict with the 'stage' name (drop, fit, apply,
+    group, slopes, catwise, average, render, ice_predict, ...),
+    its wall time in 'seconds' and whatever that stage counts: e.g. 'colname',
+    'rows', 'leaves', 'slopes', 'ignored' and 'nbytes', the size of the
+    largest array the stage builds. E.g., to see where the time goes:
+
+        events = []
+        with profiling(events.append):
+            plot_stratpd(X, y, 'x1', 'y')
+        pd.DataFrame(events)
+
+    Callbacks are held in a contextvars.ContextVar, so a with-block in one
+    thread (or asyncio task) only sees its own calls, not those other
+    threads make at the same time. stratx's own thread pools (n_jobs in
+    gridsearch and predict_ice()) carry the callbacks into their workers;
+    see in_context(). stratpd_sweep()'s worker processes do not report.
+
+    Events are also logged at DEBUG level to the 'stratx.profile' logger.
+    With neither a callback nor that logger enabled, nothing is emitted.
     """
-    leaf_samples = []
-    for i in range(ntrees):
-        """
-        Each groupby gets a list of all X indexes associated with same leaf. 4 leaves would
-        get 4 arrays of X indexes; e.g.,
-        array([array([0, 1, 2, 3, 4, 5, 6, 7, 8, 9]),
-               array([10, 11, 12, 13, 14, 15]), array([16, 17, 18, 19, 20]),
-               array([21, 22, 23, 24, 25, 26, 27, 28, 29]), ... )
-        """
-        sample_idxs_in_leaf = d.groupby(f'tree{i}')['index'].apply(lambda x: x.values)
-        leaf_samples.extend(sample_idxs_in_leaf) # add [...sample idxs...] for each leaf
-    return leaf_samples
+    token = _profilers.set(_profilers.get() + (callback,))
+    try:
+        yield
+    finally:
+        _profilers.reset(token)
 
 
-def collect_point_betas(X, y, colname, leaves, nbins:int):
-    ignored = 0
-    leaf_xranges = []
-    leaf_slopes = []
-    point_betas = np.full(shape=(len(X),), fill_value=np.nan)
+def in_context(fn):
+    """
+    Wrap fn so that every call runs in a fresh copy of the caller's
+    contextvars, carrying profiling() callbacks into pool threads; e.g.,
+    pool.map(in_context(compute), cells).
+    """
+    context = contextvars.copy_context()
+    return lambda *args: context.copy().run(fn, *args)
 
-    for samples in leaves: # samples is set of obs indexes that live in a single leaf
-        leaf_all_x = X.iloc[samples]
-        leaf_x = leaf_all_x[colname].values
-        leaf_y = y.iloc[samples].values
-        # Right edge of last bin is max(leaf_x) but that means we ignore the last value
-        # every time. Tweak domain right edge a bit so max(leaf_x) falls in last bin.
-        last_bin_extension = 0.0000001
-        domain = (np.min(leaf_x), np.max(leaf_x)+last_bin_extension)
-        bins = np.linspace(*domain, num=nbins+1, endpoint=True)
-        binned_idx = np.digitize(leaf_x, bins) # bin number for values in leaf_x
-        for b in range(1, len(bins)+1):
-            bin_x = leaf_x[binned_idx == b]
-            bin_y = leaf_y[binned_idx == b]
-            if len(bin_x) < 2: # could be none or 1 in bin
-                ignored += len(bin_x)
-                continue
-            r = (np.min(bin_x), np.max(bin_x))
-            if len(bin_x)<2 or np.isclose(r[0], r[1]):
-    #             print(f'ignoring {bin_x} -> {bin_y} for same range')
-                ignored += len(bin_x)
-                continue
-            lm = LinearRegression()
-            leaf_obs_idx_for_bin = np.nonzero((leaf_x>=bins[b-1]) &(leaf_x<bins[b]))
-            obs_idx = samples[leaf_obs_idx_for_bin]
-            lm.fit(bin_x.reshape(-1, 1), bin_y)
-            point_betas[obs_idx] = lm.coef_[0]
-            leaf_slopes.append(lm.coef_[0])
-            leaf_xranges.append(r)
-
-    leaf_slopes = np.array(leaf_slopes)
-    return leaf_xranges, leaf_slopes, point_betas, ignored
 
+def emit(stage:str, seconds:float, **counters):
+    "Send a profiling event to the profiling() callbacks and 'stratx.profile' logger, if any"
+    callbacks = _profilers.get()
+    if not callbacks and not profile_log.isEnabledFor(logging.DEBUG):
+        return
+    event = dict(stage=stage, seconds=seconds, **counters)
+    for callback in callbacks:
+        callback(event)
+    profile_log.debug("%s", event)
 
-def plot_stratpd_binned(X, y, colname, targetname,
-                 ntrees=1, min_samples_leaf=10, bootstrap=False,
-                 max_features=1.0,
-                 nbins=3,  # piecewise binning
-                 nbins_smoothing=None,  # binning of overall X[colname] space in plot
-                 supervised=True,
-                 ax=None,
-                 xrange=None,
-                 yrange=None,
-                 title=None,
-                 nlines=None,
-                 show_xlabel=True,
-                 show_ylabel=True,
-                 show_pdp_line=False,
-                 show_slope_lines=True,
-                 pdp_marker_size=5,
-                 pdp_line_width=.5,
-                 slope_line_color='#2c7fb8',
-                 slope_line_width=.5,
-                 slope_line_alpha=.3,
-                 pdp_line_color='black',
-                 pdp_marker_color='black',
-                 verbose=False
-                 ):
 
-    if supervised:
-        rf = RandomForestRegressor(n_estimators=ntrees,
-                                   min_samples_leaf=min_samples_leaf,
-                                   bootstrap=bootstrap,
-                                   max_features=max_features)
-        rf.fit(X.drop(colname, axis=1), y)
-        if verbose:
-            print(f"Strat Partition RF: missing {colname} training R^2 {rf.score(X.drop(colname, axis=1), y)}")
+@contextmanager
+def timed(timings:dict, stage:str, **counters):
+    """
+    Add the wall time spent in the with-block to timings[stage] (if timings
+    isn't None) and emit() it as a profiling event along with counters.
+    The block gets the counters dict to add what it counted, e.g.,
 
-    else:
-        """
-        Wow. Breiman's trick works in most cases. Falls apart on Boston housing MEDV target vs AGE
-        """
-        if verbose: print("USING UNSUPERVISED MODE")
-        X_synth, y_synth = conjure_twoclass(X)
+        with timed(timings, 'apply') as counters:
+            leaves = leaf_samples(rf, X_not_c)
+            counters['leaves'] = len(leaves)
+    """
+    start = time.perf_counter()
+    try:
+        yield counters
+    finally:
+        elapsed = time.perf_counter() - start
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+        emit(stage, elapsed, **counters)
+
+
+def stratify(X, y, colname,
+             ntrees=1, min_samples_leaf=10, bootstrap=False,
+             max_features=1.0,
+             supervised=True,
+             verbose=False,
+             timings=None):
+    """
+    First stage of every StratPD/CatStratPD computation: drop colname from X,
+    fit the stratification forest on what's left and find the leaf of every
+    observation. Each of those happens exactly once and the results are passed
+    on to the later stages. Returns (X_not_c, rf, leaves) where X_not_c is a
+    float32 matrix, which is what the forest works with anyway, so sklearn
+    does not convert X again during fit() and apply().
+    """
+    if timings is None:
+        timings = {}
+
+    X_not_c = drop_column(X, colname, timings)
+
+    rf, leaves = fit_stratifier(X_not_c, y, colname=colname,
+                                ntrees=ntrees, min_samples_leaf=min_samples_leaf,
+                                bootstrap=bootstrap, max_features=max_features,
+                                supervised=supervised, verbose=verbose, timings=timings)
+    return X_not_c, rf, leaves
+
+
+def drop_column(X:pd.DataFrame, colname, timings=None) -> np.ndarray:
+    "X without colname as the float32 matrix the stratification forest works with"
+    with timed(timings, 'drop', colname=colname) as counters:
+        X_not_c = X.loc[:, X.columns != colname].to_numpy(dtype=np.float32)
+        counters['nbytes'] = X_not_c.nbytes
+    return X_not_c
+
+
+def fit_stratifier(X_not_c:np.ndarray, y, colname=None,
+                   ntrees=1, min_samples_leaf=10, bootstrap=False,
+                   max_features=1.0,
+                   supervised=True,
+                   verbose=False,
+                   timings=None):
+    """
+    Fit the stratification forest to X_not_c, a matrix of every column
+    except colname, and index which leaf each observation lands in.
+    Returns (rf, leaves). stratify() without the DataFrame handling.
+    """
+    from sklearn.ensemble import RandomForestRegressor
+
+    if timings is None:
+        timings = {}
+
+    with timed(timings, 'fit', colname=colname, rows=len(X_not_c), ntrees=ntrees):
         rf = RandomForestRegressor(n_estimators=ntrees,
                                    min_samples_leaf=min_samples_leaf,
                                    bootstrap=bootstrap,
                                    max_features=max_features,
                                    oob_score=False)
-        rf.fit(X_synth.drop(colname, axis=1), y_synth)
+        if supervised:
+            rf.fit(X_not_c, y)
+            if verbose:
+                print(f"Strat Partition RF: missing {colname} training R^2 {rf.score(X_not_c, y)}")
+        else:
+            """
+            Wow. Breiman's trick works in most cases. Falls apart on Boston housing MEDV target vs AGE
+            """
+            if verbose: print("USING UNSUPERVISED MODE")
+            X_synth, y_synth = conjure_twoclass(X_not_c)
+            rf.fit(X_synth, y_synth)
+
+    with timed(timings, 'apply', colname=colname) as counters:
+        leaves = leaf_samples(rf, X_not_c)
+        counters['leaves'] = len(leaves)
+        counters['nbytes'] = leaves.samples.nbytes
 
-    leaves = leaf_samples(rf, X.drop(colname, axis=1))
-    nnodes = rf.estimators_[0].tree_.node_count
     if verbose:
+        nnodes = rf.estimators_[0].tree_.node_count
         print(f"Partitioning 'x not {colname}': {nnodes} nodes in (first) tree, "
               f"{len(rf.estimators_)} trees, {len(leaves)} total leaves")
 
-    leaf_xranges, leaf_slopes, point_betas, ignored = \
-        collect_point_betas(X, y, colname, leaves, nbins)
-    Xbetas = np.vstack([X[colname].values, point_betas]).T # get x_c, beta matrix
-    # Xbetas = Xbetas[Xbetas[:,0].argsort()] # sort by x coordinate (not needed)
+    return rf, leaves
 
-    #print(f"StratPD num samples ignored {ignored}/{len(X)} for {colname}")
 
-    x = Xbetas[:, 0]
-    domain = (np.min(x), np.max(x))  # ignores any max(x) points as no slope info after that
-    if nbins_smoothing is None:
-        # use all unique values as bin edges if no bin width
-        bins_smoothing = np.array(sorted(np.unique(x)))
-    else:
-        bins_smoothing = np.linspace(*domain, num=nbins_smoothing + 1, endpoint=True)
-
-    noinfo = np.isnan(Xbetas[:, 1])
-    Xbetas = Xbetas[~noinfo]
-
-    avg_slopes_per_bin, _, _ = binned_statistic(x=Xbetas[:, 0], values=Xbetas[:, 1],
-                                                bins=bins_smoothing, statistic='mean')
-
-    # beware: avg_slopes_per_bin might have nan for empty bins
-    bin_deltas = np.diff(bins_smoothing)
-    delta_ys = avg_slopes_per_bin * bin_deltas  # compute y delta across bin width to get up/down bump for this bin
-
-    # print('bins_smoothing', bins_smoothing, ', deltas', bin_deltas)
-    # print('avgslopes', delta_ys)
-
-    # manual cumsum
-    delta_ys = np.concatenate([np.array([0]), delta_ys])  # we start at 0 for min(x)
-    pdpx = []
-    pdpy = []
-    cumslope = 0.0
-    # delta_ys_ = np.concatenate([np.array([0]), delta_ys])  # we start at 0 for min(x)
-    for x, slope in zip(bins_smoothing, delta_ys):
-        if np.isnan(slope):
-            # print(f"{x:5.3f},{cumslope:5.1f},{slope:5.1f} SKIP")
-            continue
-        cumslope += slope
-        pdpx.append(x)
-        pdpy.append(cumslope)
-        # print(f"{x:5.3f},{cumslope:5.1f},{slope:5.1f}")
-    pdpx = np.array(pdpx)
-    pdpy = np.array(pdpy)
-
-    # PLOT
+def print_timings(timings:dict, what:str):
+    stages = ", ".join(f"{stage} {t:.3f}s" for stage, t in timings.items())
+    print(f"{what} {sum(timings.values()):.3f}s: {stages}")
 
-    if ax is None:
-        fig, ax = plt.subplots(1,1)
 
-    # Draw bin left edge markers; ignore bins with no data (nan)
-    ax.scatter(pdpx, pdpy,
-               s=pdp_marker_size, c=pdp_marker_color)
+def collect_point_betas(X, y, colname, leaves:LeafIndex, nbins:int):
+    """
+    Split the X[colname] range of each leaf into nbins equal-width bins and
+    fit a line through the x,y of each bin. Returns the x range and slope of
+    each bin with at least 2 distinct x, the slope (beta) associated with
+    each observation (from the last tree whose bin had one; NaN otherwise),
+    and how many observations were ignored.
+
+    The slope of a single-feature least squares fit is cov(x,y)/var(x), so
+    rather than a LinearRegression per bin, all (leaf, bin) groups are done
+    at once: one sort by (leaf, bin), then segmented sums of x, y and of the
+    centered products (x-mean_x)(y-mean_y) and (x-mean_x)^2.
+    """
+    ignored = 0
+    point_betas = np.full(shape=(len(X),), fill_value=np.nan)
+    if len(leaves)==0:
+        return np.zeros((0,2)), np.zeros(0), point_betas, ignored
+    samples = leaves.samples
+    leaf_ids = leaves.leaf_ids()
+    leaf_x = X[colname].values[samples].astype(float)
+    leaf_y = y.values[samples].astype(float)
+
+    # Right edge of last bin is max(leaf_x) but that means we ignore the last value
+    # every time. Tweak domain right edge a bit so max(leaf_x) falls in last bin.
+    # Bin edges per leaf are computed exactly as np.linspace() would.
+    last_bin_extension = 0.0000001
+    starts = leaves.offsets[:-1]
+    lo = np.minimum.reduceat(leaf_x, starts)
+    hi = np.maximum.reduceat(leaf_x, starts) + last_bin_extension
+    step = (hi - lo) / nbins
+    bins = np.arange(nbins+1) * step.reshape(-1,1) + lo.reshape(-1,1)
+    bins[:, -1] = hi
+
+    # Bin number as np.digitize(leaf_x, bins) would give it: b such that
+    # bins[b-1] <= x < bins[b]. Guess from the bin width then fix any
+    # off-by-one from floating-point rounding against the actual edges.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        b = np.floor((leaf_x - lo[leaf_ids]) / step[leaf_ids])
+    b = np.where(step[leaf_ids] > 0, b, nbins)
+    b = np.clip(b, 0, nbins).astype(int) + 1
+    b -= (b >= 1) & (leaf_x < bins[leaf_ids, np.maximum(b-1, 0)])
+    b += (b <= nbins) & (leaf_x >= bins[leaf_ids, np.minimum(b, nbins)])
+
+    order = np.lexsort((b, leaf_ids)) # group by leaf then bin
+    group = leaf_ids[order] * (nbins + 2) + b[order]
+    samples, leaf_x, leaf_y = samples[order], leaf_x[order], leaf_y[order]
+    new_group = np.empty(len(group), dtype=bool)
+    new_group[0] = True
+    new_group[1:] = group[1:] != group[:-1]
+    gstarts = np.flatnonzero(new_group)
+    gsizes = np.diff(np.append(gstarts, len(group)))
+    gid = np.repeat(np.arange(len(gstarts)), gsizes)
+
+    minx = np.minimum.reduceat(leaf_x, gstarts)
+    maxx = np.maximum.reduceat(leaf_x, gstarts)
+    mean_x = np.add.reduceat(leaf_x, gstarts) / gsizes
+    mean_y = np.add.reduceat(leaf_y, gstarts) / gsizes
+    dx = leaf_x - mean_x[gid]
+    dy = leaf_y - mean_y[gid]
+    sxx = np.add.reduceat(dx * dx, gstarts)
+    sxy = np.add.reduceat(dx * dy, gstarts)
+
+    # could be none or 1 in bin or all same x value
+    keep = (gsizes >= 2) & ~np.isclose(minx, maxx)
+    ignored = int(np.sum(gsizes[~keep]))
+    leaf_slopes = sxy[keep] / sxx[keep]
+    leaf_xranges = np.column_stack([minx[keep], maxx[keep]])
+
+    # With multiple trees an observation is in many bins; like the old
+    # leaf by leaf loop, the bin from the last tree wins.
+    has_beta = keep[gid]
+    obs_idx = samples[has_beta][::-1]
+    obs_beta = (sxy / np.where(keep, sxx, 1.0))[gid][has_beta][::-1]
+    obs_idx, last = np.unique(obs_idx, return_index=True)
+    point_betas[obs_idx] = obs_beta[last]
 
-    if show_pdp_line:
-        ax.plot(pdpx, pdpy,
-                lw=pdp_line_width, c=pdp_line_color)
+    return leaf_xranges, leaf_slopes, point_betas, ignored
 
-    if xrange is not None:
-        ax.set_xlim(*xrange)
-    else:
-        ax.set_xlim(*domain)
-    if yrange is not None:
-        ax.set_ylim(*yrange)
 
-    if show_slope_lines:
-        segments = []
-        for xr, slope in zip(leaf_xranges, leaf_slopes):
-            w = np.abs(xr[1] - xr[0])
-            delta_y = slope * w
-            closest_x_i = np.abs(pdpx - xr[0]).argmin() # find curve point for xr[0]
-            closest_x = pdpx[closest_x_i]
-            closest_y = pdpy[closest_x_i]
-            one_line = [(closest_x, closest_y), (closest_x+w, closest_y + delta_y)]
-            segments.append( one_line )
-
-        # if nlines is not None:
-        #     nlines = min(nlines, len(segments))
-        #     idxs = np.random.randint(low=0, high=len(segments), size=nlines)
-        #     segments = np.array(segments)[idxs]
-
-        lines = LineCollection(segments, alpha=slope_line_alpha, color=slope_line_color, linewidths=slope_line_width)
-        ax.add_collection(lines)
+class StratPDResult:
+    """
+    Everything StratPD computes for one numeric column, without any plotting.
+    pdpx, pdpy is the partial dependence curve; leaf_xranges and leaf_slopes
+    are the per-leaf slope segments it was averaged from. domain is
+    (min, max) of X[colname]. Xbetas (x_c, beta per observation) is only
+    set by stratpd_binned(); leaf_sizes only by stratpd(). timings maps each
+    pipeline stage name to the seconds it took.
+    """
+    def __init__(self, colname, leaf_xranges, leaf_slopes, pdpx, pdpy, ignored,
+                 domain, leaf_sizes=None, Xbetas=None, timings=None):
+        self.colname = colname
+        self.leaf_xranges = leaf_xranges
+        self.leaf_slopes = leaf_slopes
+        self.leaf_sizes = leaf_sizes
+        self.pdpx = pdpx
+        self.pdpy = pdpy
+        self.ignored = ignored
+        self.domain = domain
+        self.Xbetas = Xbetas
+        self.timings = timings
+
+
+def stratpd_binned(X, y, colname,
+                   ntrees=1, min_samples_leaf=10, bootstrap=False,
+                   max_features=1.0,
+                   nbins=3,  # piecewise binning
+                   nbins_smoothing=None,  # binning of overall X[colname] space in plot
+                   supervised=True,
+                   verbose=False) -> StratPDResult:
+    """
+    Compute, but do not plot, the binned StratPD curve for X[colname].
+    See plot_stratpd_binned().
+    """
+    from scipy.stats import binned_statistic
+
+    timings = {}
+    X_not_c, rf, leaves = \
+        stratify(X, y, colname, ntrees=ntrees, min_samples_leaf=min_samples_leaf,
+                 bootstrap=bootstrap, max_features=max_features,
+                 supervised=supervised, verbose=verbose, timings=timings)
+
+    with timed(timings, 'slopes', colname=colname) as counters:
+        leaf_xranges, leaf_slopes, point_betas, ignored = \
+            collect_point_betas(X, y, colname, leaves, nbins)
+        counters.update(slopes=len(leaf_slopes), ignored=ignored)
+    Xbetas = np.vstack([X[colname].values, point_betas]).T # get x_c, beta matrix
+    # Xbetas = Xbetas[Xbetas[:,0].argsort()] # sort by x coordinate (not needed)
 
-    if show_xlabel:
-        ax.set_xlabel(colname)
-    if show_ylabel:
-        ax.set_ylabel(targetname)
-    if title is not None:
-        ax.set_title(title)
+    #print(f"StratPD num samples ignored {ignored}/{len(X)} for {colname}")
 
-    return leaf_xranges, leaf_slopes, Xbetas, pdpx, pdpy, ignored
+    with timed(timings, 'average', colname=colname):
+        x = Xbetas[:, 0]
+        domain = (np.min(x), np.max(x))  # ignores any max(x) points as no slope info after that
+        if nbins_smoothing is None:
+            # use all unique values as bin edges if no bin width
+            bins_smoothing = np.array(sorted(np.unique(x)))
+        else:
+            bins_smoothing = np.linspace(*domain, num=nbins_smoothing + 1, endpoint=True)
+
+        noinfo = np.isnan(Xbetas[:, 1])
+        Xbetas = Xbetas[~noinfo]
+
+        avg_slopes_per_bin, _, _ = binned_statistic(x=Xbetas[:, 0], values=Xbetas[:, 1],
+                                                    bins=bins_smoothing, statistic='mean')
+
+        # beware: avg_slopes_per_bin might have nan for empty bins
+        bin_deltas = np.diff(bins_smoothing)
+        delta_ys = avg_slopes_per_bin * bin_deltas  # compute y delta across bin width to get up/down bump for this bin
+
+        # print('bins_smoothing', bins_smoothing, ', deltas', bin_deltas)
+        # print('avgslopes', delta_ys)
+
+        # manual cumsum
+        delta_ys = np.concatenate([np.array([0]), delta_ys])  # we start at 0 for min(x)
+        pdpx = []
+        pdpy = []
+        cumslope = 0.0
+        # delta_ys_ = np.concatenate([np.array([0]), delta_ys])  # we start at 0 for min(x)
+        for x, slope in zip(bins_smoothing, delta_ys):
+            if np.isnan(slope):
+                # print(f"{x:5.3f},{cumslope:5.1f},{slope:5.1f} SKIP")
+                continue
+            cumslope += slope
+            pdpx.append(x)
+            pdpy.append(cumslope)
+            # print(f"{x:5.3f},{cumslope:5.1f},{slope:5.1f}")
+        pdpx = np.array(pdpx)
+        pdpy = np.array(pdpy)
 
+    if verbose:
+        print_timings(timings, f"binned StratPD {colname}")
+    return StratPDResult(colname, leaf_xranges, leaf_slopes, pdpx, pdpy, ignored,
+                         domain=domain, Xbetas=Xbetas, timings=timings)
 
-def plot_stratpd(X, y, colname, targetname,
+
+def plot_stratpd_binned(X, y, colname, targetname,
                  ntrees=1, min_samples_leaf=10, bootstrap=False,
                  max_features=1.0,
-                 # binning of overall X[colname] space in plot
+                 nbins=3,  # piecewise binning
+                 nbins_smoothing=None,  # binning of overall X[colname] space in plot
                  supervised=True,
                  ax=None,
                  xrange=None,
@@ -248,64 +439,255 @@ def plot_stratpd(X, y, colname, targetname,
                  slope_line_alpha=.3,
                  pdp_line_color='black',
                  pdp_marker_color='black',
+                 nlines_sample='random',
+                 raster='auto',
+                 random_state=None,
                  verbose=False
                  ):
-    if supervised:
-        rf = RandomForestRegressor(n_estimators=ntrees,
-                                   min_samples_leaf=min_samples_leaf,
-                                   bootstrap=bootstrap,
-                                   max_features=max_features)
-        rf.fit(X.drop(colname, axis=1), y)
-        if verbose:
-            print(f"Strat Partition RF: missing {colname} training R^2 {rf.score(X.drop(colname, axis=1), y)}")
+    r = stratpd_binned(X, y, colname,
+                       ntrees=ntrees, min_samples_leaf=min_samples_leaf, bootstrap=bootstrap,
+                       max_features=max_features, nbins=nbins, nbins_smoothing=nbins_smoothing,
+                       supervised=supervised, verbose=verbose)
+
+    render_stratpd(r, targetname, ax=ax, xrange=xrange, yrange=yrange, title=title,
+                   nlines=nlines, show_xlabel=show_xlabel, show_ylabel=show_ylabel,
+                   show_pdp_line=show_pdp_line, show_slope_lines=show_slope_lines,
+                   pdp_marker_size=pdp_marker_size, pdp_line_width=pdp_line_width,
+                   slope_line_color=slope_line_color, slope_line_width=slope_line_width,
+                   slope_line_alpha=slope_line_alpha, pdp_line_color=pdp_line_color,
+                   pdp_marker_color=pdp_marker_color, nlines_sample=nlines_sample,
+                   raster=raster, random_state=random_state)
+
+    return r.leaf_xranges, r.leaf_slopes, r.Xbetas, r.pdpx, r.pdpy, r.ignored
+
+
+def stratpd(X, y, colname,
+            ntrees=1, min_samples_leaf=10, bootstrap=False,
+            max_features=1.0,
+            supervised=True,
+            verbose=False,
+            cache:'StratCache'=None) -> StratPDResult:
+    """
+    Compute, but do not plot, the StratPD partial dependence curve of y on
+    numeric X[colname]. Never touches matplotlib; see plot_stratpd() to draw it.
+    With a StratCache, a repeated call on the same data returns the cached
+    result; see StratCache.
+    """
+    params = dict(ntrees=ntrees, min_samples_leaf=min_samples_leaf, bootstrap=bootstrap,
+                  max_features=max_features, supervised=supervised)
 
-    else:
-        """
-        Wow. Breiman's trick works in most cases. Falls apart on Boston housing MEDV target vs AGE
-        """
-        if verbose: print("USING UNSUPERVISED MODE")
-        X_synth, y_synth = conjure_twoclass(X)
-        rf = RandomForestRegressor(n_estimators=ntrees,
-                                   min_samples_leaf=min_samples_leaf,
-                                   bootstrap=bootstrap,
-                                   max_features=max_features,
-                                   oob_score=False)
-        rf.fit(X_synth.drop(colname, axis=1), y_synth)
+    def curve(leaves, timings):
+        return stratpd_curve(X[colname].values, np.asarray(y), leaves, colname,
+                             verbose=verbose, timings=timings)
 
-    leaves = leaf_samples(rf, X.drop(colname, axis=1))
-    nnodes = rf.estimators_[0].tree_.node_count
-    if verbose:
-        print(f"Partitioning 'x not {colname}': {nnodes} nodes in (first) tree, "
-              f"{len(rf.estimators_)} trees, {len(leaves)} total leaves")
+    if cache is not None:
+        return cache.result('stratpd', X, y, colname, params, curve, verbose=verbose)
+    timings = {}
+    X_not_c, rf, leaves = stratify(X, y, colname, verbose=verbose, timings=timings, **params)
+    return curve(leaves, timings)
+
+
+def stratpd_curve(x:np.ndarray, y:np.ndarray, leaves:LeafIndex, colname=None,
+                  verbose=False, timings=None, xy_sums=None) -> StratPDResult:
+    """
+    The part of stratpd() after stratification: given the x_c values, y and
+    the leaves of the stratification forest, collect the discrete leaf slopes
+    and integrate their average into the partial dependence curve. Pass the
+    leaf_xy_sums() of the leaves as xy_sums instead if already computed.
+    """
+    if timings is None:
+        timings = {}
+
+    if xy_sums is None:
+        with timed(timings, 'group', colname=colname) as counters:
+            xy_sums = leaf_xy_sums(leaves, x, y)
+            counters.update(groups=len(xy_sums[0]), nbytes=sum(a.nbytes for a in xy_sums))
+    return stratpd_from_sums(xy_sums, colname, verbose=verbose, timings=timings, n=len(x))
+
+
+def stratpd_from_sums(xy_sums, colname=None, verbose=False, timings=None, n=None) -> StratPDResult:
+    """
+    Finish StratPD from nothing but the per-(leaf, x) sums and counts of
+    leaf_xy_sums() (or merged/streamed versions of them): leaf slopes, then
+    their average integrated into the partial dependence curve. Every
+    observation lands in some leaf of every tree so the groups' x values
+    are exactly the unique x values of the data. n is only for messages.
+    """
+    if timings is None:
+        timings = {}
 
-    leaf_xranges, leaf_sizes, leaf_slopes, ignored = \
-        collect_discrete_slopes(rf, X, y, colname)
+    with timed(timings, 'slopes', colname=colname) as counters:
+        leaf_xranges, leaf_sizes, leaf_slopes, ignored = discrete_slopes(*xy_sums)
+        counters.update(slopes=len(leaf_slopes), ignored=ignored)
     # leaf_xranges, leaf_sizes, leaf_slopes, _, ignored = \
         #collect_leaf_slopes(rf, X, y, colname, nbins=0, isdiscrete=1, verbose=0)
 
     # print('leaf_xranges', leaf_xranges)
     # print('leaf_slopes', leaf_slopes)
 
-    real_uniq_x = np.array(sorted(np.unique(X[colname])))
     if verbose:
-        print(f"discrete StratPD num samples ignored {ignored}/{len(X)} for {colname}")
+        print(f"discrete StratPD num samples ignored {ignored}/{n} for {colname}")
 
-    slope_at_x = avg_values_at_x(real_uniq_x, leaf_xranges, leaf_slopes)
-    # slope_at_x = weighted_avg_values_at_x(real_uniq_x, leaf_xranges, leaf_slopes, leaf_sizes, use_weighted_avg=True)
+    with timed(timings, 'average', colname=colname) as counters:
+        real_uniq_x = np.unique(xy_sums[1])
+        counters['x'] = len(real_uniq_x)
+        slope_at_x = avg_values_at_x(real_uniq_x, leaf_xranges, leaf_slopes)
+        # slope_at_x = avg_values_at_x(real_uniq_x, leaf_xranges, leaf_slopes, leaf_weights=...)
+        pdpx, pdpy = integrate_slopes(real_uniq_x, slope_at_x)
 
+    if verbose:
+        print_timings(timings, f"StratPD {colname}")
+    domain = (real_uniq_x[0], real_uniq_x[-1])  # ignores any max(x) points as no slope info after that
+    return StratPDResult(colname, leaf_xranges, leaf_slopes, pdpx, pdpy, ignored,
+                         domain=domain, leaf_sizes=leaf_sizes, timings=timings)
+
+
+def integrate_slopes(uniq_x, slope_at_x):
+    "Partial dependence curve pdpx, pdpy from the average slope at each sorted uniq_x"
     # Drop any nan slopes; implies we have no reliable data for that range
     # Make sure to drop uniq_x values too :)
     notnan_idx = ~np.isnan(slope_at_x) # should be same for slope_at_x and r2_at_x
     slope_at_x = slope_at_x[notnan_idx]
-    pdpx = real_uniq_x[notnan_idx]
+    pdpx = uniq_x[notnan_idx]
 
     dx = np.diff(pdpx)
     y_deltas = slope_at_x[:-1] * dx  # last slope is nan since no data after last x value
     # print(f"y_deltas: {y_deltas}")
     pdpy = np.cumsum(y_deltas)                    # we lose one value here
     pdpy = np.concatenate([np.array([0]), pdpy])  # add back the 0 we lost
+    return pdpx, pdpy
+
+
+def stratpd_nested(X, y, colname,
+                   min_samples_leaf_values=(2,5,10,20,30),
+                   ntrees=1, bootstrap=False,
+                   max_features=1.0,
+                   supervised=True,
+                   verbose=False) -> dict:
+    """
+    Approximate StratPD for every min_samples_leaf in
+    min_samples_leaf_values from a single stratification forest grown with
+    the smallest of them. Each coarser partition is cut from that forest
+    rather than refit: subtrees too small for a larger min_samples_leaf to
+    split collapse into one leaf (collapse_leaves()), and the deep leaves'
+    per-(leaf, x) sums and counts merge into it (merge_xy_sums()). The
+    whole grid costs about one fit.
+
+    This is not the partition a forest fit with that min_samples_leaf
+    would find. Such a fit can choose different split points, while a
+    nested partition keeps the deep forest's splits, some of which leave
+    fewer than min_samples_leaf samples on one side. Slope counts and
+    curves track a refit closely but not exactly. Use it to scan a grid
+    cheaply, then refit the value you settle on. Returns
+    {min_samples_leaf: StratPDResult}.
+    """
+    timings = {}
+    X_not_c, rf, leaves = \
+        stratify(X, y, colname, ntrees=ntrees, min_samples_leaf=min(min_samples_leaf_values),
+                 bootstrap=bootstrap, max_features=max_features,
+                 supervised=supervised, verbose=verbose, timings=timings)
+    x, y = X[colname].values, np.asarray(y)
+    with timed(timings, 'group', colname=colname):
+        xy_sums = leaf_xy_sums(leaves, x, y)
+    results = {}
+    for msl in min_samples_leaf_values:
+        msl_timings = dict(timings)
+        with timed(msl_timings, 'collapse'):
+            msl_sums = collapse_xy_sums(rf, xy_sums, msl)
+        results[msl] = stratpd_curve(x, y, None, colname, verbose=verbose,
+                                     timings=msl_timings, xy_sums=msl_sums)
+    return results
+
+
+def collapse_xy_sums(rf, xy_sums, min_samples_leaf:int):
+    "leaf_xy_sums() of rf's leaves merged into the leaves of a min_samples_leaf partition"
+    leaf_keys, xs, ysums, counts = xy_sums
+    return merge_xy_sums(collapse_leaves(rf, min_samples_leaf)[leaf_keys], xs, ysums, counts)
+
+
+def plot_stratpd(X, y, colname, targetname,
+                 ntrees=1, min_samples_leaf=10, bootstrap=False,
+                 max_features=1.0,
+                 # binning of overall X[colname] space in plot
+                 supervised=True,
+                 ax=None,
+                 xrange=None,
+                 yrange=None,
+                 title=None,
+                 nlines=None,
+                 show_xlabel=True,
+                 show_ylabel=True,
+                 show_pdp_line=False,
+                 show_slope_lines=True,
+                 pdp_marker_size=5,
+                 pdp_line_width=.5,
+                 slope_line_color='#2c7fb8',
+                 slope_line_width=.5,
+                 slope_line_alpha=.3,
+                 pdp_line_color='black',
+                 pdp_marker_color='black',
+                 nlines_sample='random',
+                 raster='auto',
+                 random_state=None,
+                 verbose=False,
+                 cache:'StratCache'=None
+                 ):
+    r = stratpd(X, y, colname,
+                ntrees=ntrees, min_samples_leaf=min_samples_leaf, bootstrap=bootstrap,
+                max_features=max_features, supervised=supervised, verbose=verbose,
+                cache=cache)
+
+    render_stratpd(r, targetname, ax=ax, xrange=xrange, yrange=yrange, title=title,
+                   nlines=nlines, show_xlabel=show_xlabel, show_ylabel=show_ylabel,
+                   show_pdp_line=show_pdp_line, show_slope_lines=show_slope_lines,
+                   pdp_marker_size=pdp_marker_size, pdp_line_width=pdp_line_width,
+                   slope_line_color=slope_line_color, slope_line_width=slope_line_width,
+                   slope_line_alpha=slope_line_alpha, pdp_line_color=pdp_line_color,
+                   pdp_marker_color=pdp_marker_color, nlines_sample=nlines_sample,
+                   raster=raster, random_state=random_state)
+
+    return r.leaf_xranges, r.leaf_slopes, r.pdpx, r.pdpy, r.ignored
+
+
+def render_stratpd(r:StratPDResult, targetname,
+                   ax=None,
+                   xrange=None,
+                   yrange=None,
+                   title=None,
+                   nlines=None,
+                   show_xlabel=True,
+                   show_ylabel=True,
+                   show_pdp_line=False,
+                   show_slope_lines=True,
+                   pdp_marker_size=5,
+                   pdp_line_width=.5,
+                   slope_line_color='#2c7fb8',
+                   slope_line_width=.5,
+                   slope_line_alpha=.3,
+                   pdp_line_color='black',
+                   pdp_marker_color='black',
+                   nlines_sample='random',
+                   raster='auto',
+                   raster_bins=(400, 300),
+                   random_state=None):
+    """
+    Draw a StratPDResult from stratpd() or stratpd_binned() onto ax (or a new
+    figure). This is the only place numeric StratPD touches matplotlib.
+
+    Each leaf's slope is drawn as a segment starting at the curve point
+    nearest its left x. With nlines, at most that many segments are drawn:
+    a random sample (random_state) or, with nlines_sample='stratified',
+    segments evenly spaced in order of x so sparse regions keep theirs.
+    With raster=True segments are drawn as one density image (see
+    segment_density()) instead of vector lines; raster='auto' does that
+    above SLOPE_RASTER_LINES segments.
+    """
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import LineCollection
 
-    # PLOT
+    start = time.perf_counter()
+    pdpx, pdpy = r.pdpx, r.pdpy
+    nsegments = 0
 
     if ax is None:
         fig, ax = plt.subplots(1,1)
@@ -318,41 +700,241 @@ def plot_stratpd(X, y, colname, targetname,
         ax.plot(pdpx, pdpy,
                 lw=pdp_line_width, c=pdp_line_color)
 
-    domain = (np.min(X[colname]), np.max(X[colname]))  # ignores any max(x) points as no slope info after that
     if xrange is not None:
         ax.set_xlim(*xrange)
     else:
-        ax.set_xlim(*domain)
+        ax.set_xlim(*r.domain)
     if yrange is not None:
         ax.set_ylim(*yrange)
 
-    if show_slope_lines:
-        segments = []
-        for xr, slope in zip(leaf_xranges, leaf_slopes):
-            w = np.abs(xr[1] - xr[0])
-            delta_y = slope * w
-            closest_x_i = np.abs(pdpx - xr[0]).argmin() # find curve point for xr[0]
-            closest_x = pdpx[closest_x_i]
-            closest_y = pdpy[closest_x_i]
-            one_line = [(closest_x, closest_y), (closest_x+w, closest_y + delta_y)]
-            segments.append( one_line )
-
-        # if nlines is not None:
-        #     nlines = min(nlines, len(segments))
-        #     idxs = np.random.randint(low=0, high=len(segments), size=nlines)
-        #     segments = np.array(segments)[idxs]
-
-        lines = LineCollection(segments, alpha=slope_line_alpha, color=slope_line_color, linewidths=slope_line_width)
-        ax.add_collection(lines)
+    if show_slope_lines and len(pdpx) > 0:
+        segments = slope_segments(r.leaf_xranges, r.leaf_slopes, pdpx, pdpy)
+        if nlines is not None and nlines < len(segments):
+            if nlines_sample == 'stratified':
+                by_x = np.argsort(segments[:,0,0], kind='stable')
+                idxs = by_x[np.linspace(0, len(segments) - 1, nlines).round().astype(int)]
+            else:
+                rng = np.random.default_rng(random_state)
+                idxs = rng.choice(len(segments), size=nlines, replace=False)
+            segments = segments[idxs]
+        nsegments = len(segments)
+
+        if raster == 'auto':
+            raster = len(segments) > SLOPE_RASTER_LINES
+        if raster and len(segments) > 0:
+            from matplotlib.colors import LinearSegmentedColormap, to_rgba
+            minx, maxx = ax.get_xlim()
+            miny, maxy = yrange if yrange is not None else (np.min(segments[:,:,1]), np.max(segments[:,:,1]))
+            density = segment_density(segments, (minx, maxx, miny, maxy), bins=raster_bins)
+            cmap = LinearSegmentedColormap.from_list('slopes', [to_rgba(slope_line_color, 0),
+                                                                to_rgba(slope_line_color, 1)])
+            ax.imshow(np.log1p(density), origin='lower', extent=(minx, maxx, miny, maxy),
+                      aspect='auto', interpolation='nearest', cmap=cmap, zorder=0)
+        else:
+            lines = LineCollection(segments, alpha=slope_line_alpha, color=slope_line_color, linewidths=slope_line_width)
+            ax.add_collection(lines)
 
     if show_xlabel:
-        ax.set_xlabel(colname)
+        ax.set_xlabel(r.colname)
     if show_ylabel:
         ax.set_ylabel(targetname)
     if title is not None:
         ax.set_title(title)
 
-    return leaf_xranges, leaf_slopes, pdpx, pdpy, ignored
+    emit('render', time.perf_counter() - start, colname=r.colname, segments=nsegments,
+         raster=bool(show_slope_lines and raster))
+    return ax
+
+
+def slope_segments(leaf_xranges, leaf_slopes, pdpx, pdpy) -> np.ndarray:
+    """
+    Return a (nleaves, 2, 2) array of line segments, one per leaf, for
+    LineCollection: the leaf's slope over the width of its x range,
+    starting at the (pdpx, pdpy) curve point nearest the left end of the
+    range. pdpx must be sorted.
+    """
+    leaf_xranges = np.asarray(leaf_xranges, dtype=float).reshape(-1, 2)
+    w = np.abs(leaf_xranges[:,1] - leaf_xranges[:,0])
+    i = nearest_index(pdpx, leaf_xranges[:,0])
+    x0, y0 = pdpx[i], pdpy[i]
+    return np.stack([np.column_stack([x0, y0]),
+                     np.column_stack([x0 + w, y0 + np.asarray(leaf_slopes) * w])], axis=1)
+
+
+def nearest_index(sorted_x:np.ndarray, values:np.ndarray) -> np.ndarray:
+    "Index of the sorted_x element nearest each of values; ties go left, as with argmin()"
+    if len(sorted_x) == 1:
+        return np.zeros(len(values), dtype=int)
+    i = np.clip(np.searchsorted(sorted_x, values), 1, len(sorted_x) - 1)
+    return np.where(values - sorted_x[i-1] <= sorted_x[i] - values, i - 1, i)
+
+
+def segment_density(segments:np.ndarray, extent, bins=(400, 300), chunksize=1_000_000) -> np.ndarray:
+    """
+    Rasterize (n, 2, 2) line segments into a bins[1] x bins[0] (y by x)
+    matrix counting how many segments pass through each pixel of extent
+    (minx, maxx, miny, maxy), for imshow(origin='lower'). Each segment
+    is sampled at the center of every pixel column it spans; at most
+    chunksize samples are expanded at a time.
+    """
+    minx, maxx, miny, maxy = extent
+    nxbins, nybins = bins
+    xscale = nxbins / (maxx - minx) if maxx > minx else 0.0
+    yscale = nybins / (maxy - miny) if maxy > miny else 0.0
+    left = np.minimum(segments[:,0,0], segments[:,1,0])
+    right = np.maximum(segments[:,0,0], segments[:,1,0])
+    c0 = np.clip(np.ceil((left - minx) * xscale - 0.5), 0, nxbins).astype(np.int64)
+    c1 = np.clip(np.floor((right - minx) * xscale - 0.5), -1, nxbins - 1).astype(np.int64)
+    ncols = np.maximum(c1 - c0 + 1, 0)
+    # segments narrower than a pixel column get one sample at their middle column
+    thin = ncols == 0
+    mid = np.clip(((left + right) / 2 - minx) * xscale, 0, nxbins - 1).astype(np.int64)
+    c0 = np.where(thin, mid, c0)
+    ncols = np.where(thin, 1, ncols)
+    dx = segments[:,1,0] - segments[:,0,0]
+    slope = np.divide(segments[:,1,1] - segments[:,0,1], dx, out=np.zeros(len(segments)), where=dx != 0)
+
+    density = np.zeros(nybins * nxbins, dtype=np.int64)
+    ends = np.cumsum(ncols)
+    begin = 0
+    while begin < len(segments):
+        end = max(begin + 1, np.searchsorted(ends, ends[begin] - ncols[begin] + chunksize, side='right'))
+        counts = ncols[begin:end]
+        seg = np.repeat(np.arange(begin, end), counts)
+        col = c0[seg] + np.arange(len(seg)) - np.repeat(np.cumsum(counts) - counts, counts)
+        x = minx + (col + 0.5) / xscale if xscale > 0 else np.full(len(seg), minx)
+        x = np.clip(x, left[seg], right[seg])
+        y = segments[seg,0,1] + slope[seg] * (x - segments[seg,0,0])
+        row = np.floor((y - miny) * yscale).astype(np.int64)
+        row[y == maxy] = nybins - 1
+        inside = (row >= 0) & (row < nybins)
+        density += np.bincount(row[inside] * nxbins + col[inside], minlength=nybins * nxbins)
+        begin = end
+    return density.reshape(nybins, nxbins)
+
+
+def leaf_xy_sums(leaves:LeafIndex, x:np.ndarray, y:np.ndarray):
+    """
+    Group the x,y of every leaf by unique x value in one vectorized pass over
+    all leaves: lexsort on (leaf, x) then sum y across each run of equal
+    (leaf, x). Returns four parallel arrays, sorted by leaf then x:
+
+        leaf_keys  forest-wide leaf id (LeafIndex.keys) of each (leaf, x) group
+        xs         the unique x value of the group
+        ysums      sum of y over the group's observations
+        counts     number of observations in the group
+
+    These sums and counts are all discrete_slopes() needs and, unlike
+    averages, can be added together across data chunks.
+    """
+    leaf = leaves.keys[leaves.leaf_ids()]
+    leaf_x = x[leaves.samples]
+    leaf_y = y[leaves.samples]
+    return merge_xy_sums(leaf, leaf_x, leaf_y.astype(float), np.ones(len(leaf), dtype=np.int64))
+
+
+def merge_xy_sums(leaf_keys, xs, ysums, counts):
+    """
+    Combine (leaf, x) groups that share the same leaf key and x value by
+    adding their ysums and counts; returns the same four arrays as
+    leaf_xy_sums(), sorted by leaf then x. Use it to merge sums computed on
+    separate chunks of data (concatenate them first) or to coarsen leaves by
+    mapping leaf_keys to parent nodes (see collapse_leaves()).
+    """
+    order = np.lexsort((xs, leaf_keys)) # sort by leaf then x
+    leaf_keys, xs, ysums, counts = leaf_keys[order], xs[order], ysums[order], counts[order]
+    if len(leaf_keys)==0:
+        return leaf_keys, xs, ysums.astype(float), counts.astype(np.int64)
+    new_group = np.empty(len(leaf_keys), dtype=bool)
+    new_group[0] = True
+    new_group[1:] = (leaf_keys[1:] != leaf_keys[:-1]) | (xs[1:] != xs[:-1])
+    starts = np.flatnonzero(new_group)
+    return leaf_keys[starts], xs[starts], \
+           np.add.reduceat(ysums, starts), np.add.reduceat(counts, starts)
+
+
+def forest_xy_sums(rf, X_not_c:np.ndarray, x:np.ndarray, y:np.ndarray):
+    """
+    leaf_xy_sums() for rows pushed through rf.apply() directly, without a
+    LeafIndex; for chunks of rows, typically ones rf was not fit on. Leaf
+    keys are forest-wide node ids as in LeafIndex.keys so the sums from
+    different chunks can be combined with merge_xy_sums().
+    """
+    leaf_ids = rf.apply(X_not_c)
+    n, ntrees = leaf_ids.shape
+    keys = (leaf_ids + tree_offsets(rf)).T.ravel()
+    return merge_xy_sums(keys, np.tile(x, ntrees), np.tile(np.asarray(y, dtype=float), ntrees),
+                         np.ones(n * ntrees, dtype=np.int64))
+
+
+def collapse_leaves(rf, min_samples_leaf:int) -> np.ndarray:
+    """
+    Map each forest-wide node id of rf (see LeafIndex.keys) to its leaf in
+    a coarser partition that approximates growing rf with a larger
+    min_samples_leaf: the highest ancestor with fewer than
+    2 * min_samples_leaf training samples, or the node itself if there's
+    none. No split of such a node could leave min_samples_leaf samples on
+    both sides, so a refit could not have split it either, and its whole
+    subtree collapses into it. Larger nodes keep rf's splits, even ones a
+    refit would have placed differently. Index the result with leaf_keys
+    and pass to merge_xy_sums() to get the coarser partition's sums.
+    """
+    reps = []
+    offset = 0
+    for t in rf.estimators_:
+        tree = t.tree_
+        left, right, n = tree.children_left, tree.children_right, tree.n_node_samples
+        isleaf = left == -1
+        stop = isleaf | (n < 2 * min_samples_leaf)
+        rep = np.arange(tree.node_count)
+        level = np.array([0])  # walk down level by level from root
+        while len(level) > 0:
+            parents = level[~isleaf[level]]
+            children = np.concatenate([left[parents], right[parents]])
+            parent_rep = rep[np.concatenate([parents, parents])]
+            rep[children] = np.where(stop[parent_rep], parent_rep, children)
+            level = children
+        reps.append(rep + offset)
+        offset += tree.node_count
+    return np.concatenate(reps)
+
+
+def discrete_slopes(leaf_keys, xs, ysums, counts):
+    """
+    Vectorized discrete_xc_space() across all leaves at once, working from
+    the per-(leaf, unique x) sums and counts of leaf_xy_sums(). The slope
+    between consecutive unique x within a leaf is rise over run of the
+    average y at those x:
+
+        (y_{i+1} - y_i) / (x_{i+1} - x_i)
+
+    Leaves whose x values are all (nearly) the same tell us nothing about
+    how x affects y and their observations are counted as ignored. Returns
+    leaf_xranges, leaf_sizes, leaf_slopes, ignored in the same order and
+    form as the old leaf by leaf loop.
+    """
+    if len(leaf_keys)==0:
+        return np.zeros((0,2)), np.zeros(0, dtype=int), np.zeros(0), 0
+    new_leaf = np.empty(len(leaf_keys), dtype=bool)
+    new_leaf[0] = True
+    new_leaf[1:] = leaf_keys[1:] != leaf_keys[:-1]
+    leaf_starts = np.flatnonzero(new_leaf)
+    leaf_ends = np.append(leaf_starts[1:], len(leaf_keys))
+    nuniq_x = leaf_ends - leaf_starts
+
+    # x is sorted within leaf so first/last group in leaf gives x range of leaf
+    keep_leaf = ~np.isclose(xs[leaf_starts], xs[leaf_ends-1])
+    nobs = np.add.reduceat(counts, leaf_starts)
+    ignored = int(np.sum(nobs[~keep_leaf]))
+    keep = np.repeat(keep_leaf, nuniq_x)
+
+    avg_y = ysums / counts
+    # slope from group i to i+1 only if both are in the same kept leaf
+    pairs = ~new_leaf[1:] & keep[1:]
+    leaf_slopes = np.diff(avg_y)[pairs] / np.diff(xs)[pairs]
+    leaf_xranges = np.column_stack([xs[:-1][pairs], xs[1:][pairs]])
+    leaf_sizes = counts[keep]
+    return leaf_xranges, leaf_sizes, leaf_slopes, ignored
 
 
 def discrete_xc_space(x: np.ndarray, y: np.ndarray, colname, verbose):
@@ -372,8 +954,6 @@ def discrete_xc_space(x: np.ndarray, y: np.ndarray, colname, verbose):
     If there is exactly one category in the leaf, the leaf provides no information
     about how the categories contribute to changes in y. We have to ignore this leaf.
     """
-    start = time.time()
-
     ignored = 0
     xy = pd.concat([pd.Series(x), pd.Series(y)], axis=1)
     xy.columns = ['x', 'y']
@@ -394,12 +974,10 @@ def discrete_xc_space(x: np.ndarray, y: np.ndarray, colname, verbose):
     leaf_xranges = np.array(list(zip(uniq_x, uniq_x[1:])))
     leaf_sizes = xy['x'].value_counts().sort_index().values
 
-    stop = time.time()
-    # print(f"discrete_xc_space {stop - start:.3f}s")
     return leaf_xranges, leaf_sizes, leaf_slopes, [], ignored
 
 
-def collect_discrete_slopes(rf, X, y, colname, verbose=False):
+def collect_discrete_slopes(rf, X, y, colname, verbose=False, leaves:LeafIndex=None):
     """
     For each leaf of each tree of the random forest rf (trained on all features
     except colname), get the samples then isolate the column of interest X values
@@ -412,80 +990,71 @@ def collect_discrete_slopes(rf, X, y, colname, verbose=False):
     associated slope for each range
 
     Only does discrete now after doing pointwise continuous slopes differently.
+    Pass in leaves from stratify() to avoid dropping colname and applying rf again.
+    All leaves are processed together by leaf_xy_sums() and discrete_slopes(),
+    which compute the same thing as calling discrete_xc_space() on each leaf.
     """
-    start = time.time()
-    leaf_slopes = []  # drop or rise between discrete x values
-    leaf_xranges = [] # drop is from one discrete value to next
-    leaf_sizes = []
-
-    ignored = 0
-
-    leaves = leaf_samples(rf, X.drop(colname, axis=1))
+    timings = {}
+    if leaves is None:
+        with timed(timings, 'apply', colname=colname):
+            leaves = leaf_samples(rf, X.drop(colname, axis=1))
 
     if verbose:
         nnodes = rf.estimators_[0].tree_.node_count
         print(f"Partitioning 'x not {colname}': {nnodes} nodes in (first) tree, "
               f"{len(rf.estimators_)} trees, {len(leaves)} total leaves")
 
-    for samples in leaves:
-        one_leaf_samples = X.iloc[samples]
-        leaf_x = one_leaf_samples[colname].values
-        leaf_y = y.iloc[samples].values
+    with timed(timings, 'slopes', colname=colname) as counters:
+        leaf_xranges, leaf_sizes, leaf_slopes, ignored = \
+            discrete_slopes(*leaf_xy_sums(leaves, X[colname].values, y.values))
+        counters.update(slopes=len(leaf_slopes), ignored=ignored)
 
-        r = (np.min(leaf_x), np.max(leaf_x))
-        if np.isclose(r[0], r[1]):
-            # print(f"ignoring xleft=xright @ {r[0]}")
-            ignored += len(leaf_x)
-            continue
-
-        leaf_xranges_, leaf_sizes_, leaf_slopes_, leaf_r2_, ignored_ = \
-            discrete_xc_space(leaf_x, leaf_y, colname=colname, verbose=verbose)
-
-        leaf_slopes.extend(leaf_slopes_)
-        leaf_xranges.extend(leaf_xranges_)
-        leaf_sizes.extend(leaf_sizes_)
-        ignored += ignored_
-
-    leaf_xranges = np.array(leaf_xranges)
-    leaf_sizes = np.array(leaf_sizes)
-    leaf_slopes = np.array(leaf_slopes)
-
-    stop = time.time()
-    if verbose: print(f"collect_leaf_slopes {stop - start:.3f}s")
+    if verbose: print_timings(timings, "collect_leaf_slopes")
     return leaf_xranges, leaf_sizes, leaf_slopes, ignored
 
 
-def avg_values_at_x(uniq_x, leaf_ranges, leaf_values):
+def avg_values_at_x(uniq_x, leaf_ranges, leaf_values, leaf_weights=None):
     """
-    Compute the weighted average of leaf_values at each uniq_x.
+    Compute the average of leaf_values at each uniq_x, where leaf_values[i]
+    applies to uniq_x values in [leaf_ranges[i][0], leaf_ranges[i][1]). If
+    leaf_weights is given (e.g., observation counts), compute the weighted
+    average sum(w*v)/sum(w) instead. NaN leaf_values are skipped, like nanmean.
 
     Value at max(x) is NaN since we have no data beyond that point.
+
+    Rather than materializing a len(uniq_x) x len(leaf_values) matrix, this
+    is a sweep: searchsorted the range endpoints into uniq_x, add each value
+    at its left edge and subtract it at its right edge in a difference array,
+    then cumsum. O((nx + k) log nx) time and O(nx) space for k ranges.
+    uniq_x must be sorted.
     """
-    start = time.time()
+    uniq_x = np.asarray(uniq_x)
     nx = len(uniq_x)
-    nslopes = len(leaf_values)
-    slopes = np.zeros(shape=(nx, nslopes))
-    i = 0  # leaf index; we get a line for each leaf
-    # collect the slope for each range (taken from a leaf) as collection of
-    # flat lines across the same x range
-    for r, slope in zip(leaf_ranges, leaf_values):
-        s = np.full(nx, slope, dtype=float)
-        # now trim line so it's only valid in range r;
-        # don't set slope on right edge
-        s[np.where( (uniq_x < r[0]) | (uniq_x >= r[1]) )] = np.nan
-        slopes[:, i] = s
-        i += 1
+    leaf_ranges = np.asarray(leaf_ranges, dtype=float).reshape(-1, 2)
+    leaf_values = np.asarray(leaf_values, dtype=float)
+    if leaf_weights is None:
+        leaf_weights = np.ones(len(leaf_values))
+    leaf_weights = np.asarray(leaf_weights, dtype=float)
+
+    ok = ~np.isnan(leaf_values)
+    leaf_ranges, leaf_values, leaf_weights = leaf_ranges[ok], leaf_values[ok], leaf_weights[ok]
+    # don't set value on right edge so both edges find first uniq_x >= edge
+    left = np.searchsorted(uniq_x, leaf_ranges[:, 0], side='left')
+    right = np.searchsorted(uniq_x, leaf_ranges[:, 1], side='left')
+
+    def sweep(weights=None):
+        d = np.bincount(left, weights=weights, minlength=nx+1) - \
+            np.bincount(right, weights=weights, minlength=nx+1)
+        return np.cumsum(d)[:nx]
+
+    nvalues = sweep() # exact int count of ranges covering each x
+    sum_values = sweep(leaf_values * leaf_weights)
+    sum_weights = sweep(leaf_weights)
     # The value could be genuinely zero so we use nan not 0 for out-of-range
-    # Now average horiz across the matrix, averaging within each range
-    # Wrap nanmean() in catcher to avoid "Mean of empty slice" warning, which
-    # comes from some rows being purely NaN; I should probably look at this sometime
-    # to decide whether that's hiding a bug (can there ever be a nan for an x range)?
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore", category=RuntimeWarning)
-        avg_value_at_x = np.nanmean(slopes, axis=1)
-
-    stop = time.time()
-    # print(f"avg_value_at_x {stop - start:.3f}s")
+    with np.errstate(divide='ignore', invalid='ignore'):
+        avg_value_at_x = sum_values / sum_weights
+    avg_value_at_x[nvalues==0] = np.nan
+
     return avg_value_at_x
 
 
@@ -498,7 +1067,19 @@ def plot_stratpd_gridsearch(X, y, colname, targetname,
                             xrange=None,
                             show_regr_line=False,
                             marginal_alpha=.05,
-                            slope_line_alpha=.1):
+                            slope_line_alpha=.1,
+                            nested=False,
+                            n_jobs=None):
+    """
+    Plot the marginal next to StratPD for each min_samples_leaf value (and,
+    if binned, each nbins value). With nested=True (not binned), all cells
+    are approximations cut from one stratification tree via stratpd_nested()
+    instead of one fit per cell, and titles read leafsz~msl. Otherwise,
+    n_jobs > 1 (-1 means all cores) computes the cells in parallel; see
+    gridsearch_results(). Rendering always happens in the calling thread.
+    """
+    import matplotlib.pyplot as plt
+
     ncols = len(min_samples_leaf_values)
     if not binned:
         fig, axes = plt.subplots(1, ncols + 1,
@@ -506,25 +1087,32 @@ def plot_stratpd_gridsearch(X, y, colname, targetname,
         marginal_plot_(X, y, colname, targetname, ax=axes[0],
                        show_regr_line=show_regr_line, alpha=marginal_alpha)
         axes[0].set_title("Marginal", fontsize=10)
+        if nested:
+            results = stratpd_nested(X, y, colname, min_samples_leaf_values, ntrees=1)
+            results = [results[msl] for msl in min_samples_leaf_values]
+        else:
+            results = gridsearch_results(
+                lambda msl: stratpd(X, y, colname, min_samples_leaf=msl, ntrees=1),
+                [(msl,) for msl in min_samples_leaf_values], n_jobs=n_jobs)
         col = 1
-        for msl in min_samples_leaf_values:
+        for msl, r in zip(min_samples_leaf_values, results):
             #print(f"---------- min_samples_leaf={msl} ----------- ")
             try:
-                leaf_xranges, leaf_slopes, pdpx, pdpy, ignored = \
-                    plot_stratpd(X, y, colname, targetname, ax=axes[col],
-                                 min_samples_leaf=msl,
-                                 xrange=xrange,
-                                 yrange=yrange,
-                                 ntrees=1,
-                                 show_ylabel=False,
-                                 slope_line_alpha=slope_line_alpha)
+                if isinstance(r, ValueError):
+                    raise r
+                render_stratpd(r, targetname, ax=axes[col],
+                               xrange=xrange,
+                               yrange=yrange,
+                               show_ylabel=False,
+                               slope_line_alpha=slope_line_alpha)
+                ignored = r.ignored
             except ValueError:
                 axes[col].set_title(
-                    f"Can't gen: leafsz={msl}",
+                    f"Can't gen: {leafsz_title(msl, nested)}",
                     fontsize=8)
             else:
                 axes[col].set_title(
-                    f"leafsz={msl}, ignored={100*ignored / len(X):.2f}%",fontsize=9)
+                    f"{leafsz_title(msl, nested)}, ignored={100*ignored / len(X):.2f}%",fontsize=9)
             col += 1
 
     else:
@@ -532,6 +1120,13 @@ def plot_stratpd_gridsearch(X, y, colname, targetname,
         fig, axes = plt.subplots(nrows, ncols + 1,
                                  figsize=((ncols + 1) * 2.5, nrows * 2.5))
 
+        cells = [(nbins, msl) for nbins in nbins_values for msl in min_samples_leaf_values]
+        results = gridsearch_results(
+            lambda nbins, msl: stratpd_binned(X, y, colname, nbins=nbins, min_samples_leaf=msl,
+                                              nbins_smoothing=nbins_smoothing, ntrees=1),
+            cells, n_jobs=n_jobs)
+        results = iter(results)
+
         row = 0
         for i, nbins in enumerate(nbins_values):
             marginal_plot_(X, y, colname, targetname, ax=axes[row, 0], show_regr_line=show_regr_line)
@@ -540,15 +1135,14 @@ def plot_stratpd_gridsearch(X, y, colname, targetname,
             col = 1
             for msl in min_samples_leaf_values:
                 #print(f"---------- min_samples_leaf={msl}, nbins={nbins:.2f} ----------- ")
+                r = next(results)
                 try:
-                    leaf_xranges, leaf_slopes, Xbetas, plot_x, plot_y, ignored = \
-                        plot_stratpd_binned(X, y, colname, targetname, ax=axes[row, col],
-                                            nbins=nbins,
-                                            min_samples_leaf=msl,
-                                            nbins_smoothing=nbins_smoothing,
-                                            yrange=yrange,
-                                            show_ylabel=False,
-                                            ntrees=1)
+                    if isinstance(r, ValueError):
+                        raise r
+                    render_stratpd(r, targetname, ax=axes[row, col],
+                                   yrange=yrange,
+                                   show_ylabel=False)
+                    ignored = r.ignored
                 except ValueError:
                     axes[row, col].set_title(
                         f"Can't gen: leafsz={msl}, nbins={nbins}",
@@ -561,6 +1155,28 @@ def plot_stratpd_gridsearch(X, y, colname, targetname,
             row += 1
 
 
+def gridsearch_results(compute, cells, n_jobs=None) -> list:
+    """
+    Return [compute(*cell) for cell in cells], except that a cell whose
+    compute raises ValueError gets the exception object instead, so one bad
+    cell doesn't sink the grid. With n_jobs > 1 (-1 means all cores) cells
+    run on a pool of threads: they all read the same X and y without copying
+    them, and the forest fit, where most of the time goes, releases the GIL.
+    """
+    def run(cell):
+        try:
+            return compute(*cell)
+        except ValueError as e:
+            return e
+
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    if n_jobs is None or n_jobs <= 1:
+        return [run(cell) for cell in cells]
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        return list(pool.map(in_context(run), cells))
+
+
 def marginal_plot_(X, y, colname, targetname, ax, alpha=.1, show_regr_line=True):
     ax.scatter(X[colname], y, alpha=alpha, label=None, s=10)
     ax.set_xlabel(colname)
@@ -568,6 +1184,7 @@ def marginal_plot_(X, y, colname, targetname, ax, alpha=.1, show_regr_line=True)
     col = X[colname]
 
     if show_regr_line:
+        from sklearn.linear_model import LinearRegression
         r = LinearRegression()
         r.fit(X[[colname]], y)
         xcol = np.linspace(np.min(col), np.max(col), num=100)
@@ -593,7 +1210,18 @@ def plot_catstratpd_gridsearch(X, y, colname, targetname,
                                min_samples_leaf_values=(2, 5, 10, 20, 30),
                                catnames=None,
                                yrange=None,
-                               cellwidth=2.5):
+                               cellwidth=2.5,
+                               nested=False,
+                               n_jobs=None):
+    """
+    Plot the marginal next to CatStratPD for each min_samples_leaf value.
+    With nested=True, all cells are approximations cut from one
+    stratification tree via catstratpd_nested() instead of one fit per
+    cell, and titles read leafsz~msl. Otherwise, n_jobs > 1
+    computes the cells in parallel; see gridsearch_results().
+    """
+    import matplotlib.pyplot as plt
+
     ncols = len(min_samples_leaf_values)
     fig, axes = plt.subplots(1, ncols + 1,
                              figsize=((ncols + 1) * cellwidth, 2.5))
@@ -601,86 +1229,329 @@ def plot_catstratpd_gridsearch(X, y, colname, targetname,
     marginal_catplot_(X, y, colname, targetname, catnames=catnames, ax=axes[0], alpha=0.05)
     axes[0].set_title("Marginal", fontsize=10)
 
+    if nested:
+        results = catstratpd_nested(X, y, colname, min_samples_leaf_values,
+                                    catnames=catnames, ntrees=1)
+        results = [results[msl] for msl in min_samples_leaf_values]
+    else:
+        results = gridsearch_results(
+            lambda msl: catstratpd(X, y, colname, catnames=catnames, min_samples_leaf=msl, ntrees=1),
+            [(msl,) for msl in min_samples_leaf_values], n_jobs=n_jobs)
     col = 1
-    for msl in min_samples_leaf_values:
+    for msl, r in zip(min_samples_leaf_values, results):
         #print(f"---------- min_samples_leaf={msl} ----------- ")
         if yrange is not None:
             axes[col].set_ylim(yrange)
         try:
+            if isinstance(r, ValueError):
+                raise r
             catcodes_, catnames_, curve, ignored = \
-                plot_catstratpd(X, y, colname, targetname, ax=axes[col],
-                                min_samples_leaf=msl,
-                                catnames=catnames,
-                                yrange=yrange,
-                                ntrees=1,
-                                show_xticks=True,
-                                show_ylabel=False,
-                                sort=None)
+                render_catstratpd(r, targetname, ax=axes[col],
+                                  yrange=yrange,
+                                  show_xticks=True,
+                                  show_ylabel=False,
+                                  sort=None)
         except ValueError:
-            axes[col].set_title(f"Can't gen: leafsz={msl}", fontsize=8)
+            axes[col].set_title(f"Can't gen: {leafsz_title(msl, nested)}", fontsize=8)
         else:
-            axes[col].set_title(f"leafsz={msl}, ign'd={ignored / len(X):.1f}%", fontsize=9)
+            axes[col].set_title(f"{leafsz_title(msl, nested)}, ign'd={ignored / len(X):.1f}%", fontsize=9)
         col += 1
 
 
-def catwise_leaves(rf, X, y, colname, verbose):
+def leafsz_title(min_samples_leaf:int, nested:bool) -> str:
+    "Gridsearch cell label; ~ marks an approximate nested partition rather than a refit"
+    return f"leafsz~{min_samples_leaf}" if nested else f"leafsz={min_samples_leaf}"
+
+
+def catwise_leaves(rf, X, y, colname, verbose, leaves:LeafIndex=None,
+                   cats:np.ndarray=None, ncats:int=None):
     """
-    Return a dataframe with the average y value for each category in each leaf
-    normalized by subtracting min avg y value from all categories.
-    The index has the complete category list. The columns are the y avg value changes
-    found in a single leaf. Each row represents a category level. E.g.,
+    Return a sparse matrix with the average y value for each category in each
+    leaf minus the average y of that leaf. Rows are category codes 0..max(code),
+    or dense category indexes if cats is given, and columns are leaves with at least 2 categories; a stored entry means
+    that category appears in that leaf. E.g., densified:
 
                        leaf0       leaf1
         category
         1         166.430176  186.796956
         2         219.590349  176.448626
-    """
-    start = time.time()
-    ignored = 0
-    # catcol = X[colname].astype('category').cat.as_ordered()
-    cats = np.unique(X[colname])
-    # catcounts = np.zeros(max(cats)+1, dtype=int)
-    leaf_sizes = []
-    leaf_avgs = []
-    maxcat = max(cats)
-    leaf_histos = pd.DataFrame(index=range(0,maxcat+1))
-    leaf_histos.index.name = 'category'
-    leaf_catcounts = pd.DataFrame(index=range(0,maxcat+1))
-    leaf_catcounts.index.name = 'category'
-    ci = 0
-    Xy = pd.concat([X, y], axis=1)
-    leaves = leaf_samples(rf, X.drop(colname, axis=1))
-    # print(f"{len(leaves)} leaves")
-    for sample in leaves:
-        combined = Xy.iloc[sample]
-        # print("\n", combined)
-        groupby = combined.groupby(colname)
-        avg_y_per_cat = groupby.mean()
-        avg_y_per_cat = avg_y_per_cat[y.name]#.iloc[:,-1]
-        if len(avg_y_per_cat) < 2:
-            # print(f"ignoring {len(sample)} obs for {len(avg_y_per_cat)} cat(s) in leaf")
-            ignored += len(sample)
-            continue
-
-        # we'll weight by count per cat later so must track
-        count_y_per_cat = combined[colname].value_counts()
-        leaf_catcounts['leaf' + str(ci)] = count_y_per_cat
-
-        # record avg y value per cat above avg y in this leaf
-        # This assignment copies cat y avgs to appropriate cat row using index
-        # leaving cats w/o representation as nan
-        avg_y = np.mean(combined[y.name])
-        leaf_avgs.append(avg_y)
-        delta_y_per_cat = avg_y_per_cat - avg_y
-        leaf_histos['leaf' + str(ci)] = delta_y_per_cat
-        leaf_sizes.append(len(sample))
-        # print(f"L avg {avg_y:.2f}:\n\t{delta_y_per_cat}")
-        ci += 1
 
+    leaf_catcounts has exactly the same sparsity structure and holds the
+    number of observations behind each entry. Both are built in one
+    vectorized pass over all leaves by leaf_xy_sums(), grouping by category
+    instead of x; see catwise_sums().
+
+    Pass cats, the dense 0..ncats-1 category index of each observation from
+    factorize_cats(), to use those as rows instead of the raw X[colname] codes
+    so that memory scales with the categories actually present.
+    """
+    timings = {}
+    if leaves is None:
+        with timed(timings, 'apply', colname=colname):
+            leaves = leaf_samples(rf, X.drop(colname, axis=1))
+    if cats is None:
+        cats = X[colname].values
+    if ncats is None:
+        ncats = np.max(cats)+1
+    with timed(timings, 'catwise', colname=colname) as counters:
+        leaf_histos, leaf_avgs, leaf_sizes, leaf_catcounts, ignored = \
+            catwise_sums(*leaf_xy_sums(leaves, cats, y.values), ncats=ncats)
+        counters.update(leaves=leaf_histos.shape[1], deltas=leaf_histos.nnz, ignored=ignored)
     # print(f"Avg of leaf avgs is {np.mean(leaf_avgs):.2f} vs y avg {np.mean(y)}")
-    stop = time.time()
-    if verbose: print(f"catwise_leaves {stop - start:.3f}s")
-    return leaf_histos, np.array(leaf_avgs), leaf_sizes, leaf_catcounts, ignored
+    if verbose: print_timings(timings, "catwise_leaves")
+    return leaf_histos, leaf_avgs, leaf_sizes, leaf_catcounts, ignored
+
+
+def catwise_sums(leaf_keys, cats, ysums, counts, ncats:int):
+    """
+    Turn the per-(leaf, category) sums and counts of y from leaf_xy_sums(),
+    sorted by leaf then category, into the catwise_leaves() results.
+    A leaf with just one category says nothing about how categories differ,
+    so its observations are ignored. Everything stays sparse: storage is
+    proportional to the number of (category, leaf) pairs actually seen, not
+    ncats * nleaves. Sorting pairs is used rather than bincount over
+    leaf*ncats+category keys since that would be dense in exactly that product.
+    """
+    from scipy.sparse import csr_matrix
+    if len(leaf_keys)==0:
+        empty = csr_matrix((ncats, 0))
+        return empty, np.zeros(0), np.zeros(0, dtype=int), empty.astype(int), 0
+    new_leaf = np.empty(len(leaf_keys), dtype=bool)
+    new_leaf[0] = True
+    new_leaf[1:] = leaf_keys[1:] != leaf_keys[:-1]
+    leaf_starts = np.flatnonzero(new_leaf)
+    ncats_in_leaf = np.diff(np.append(leaf_starts, len(leaf_keys)))
+    leaf_sizes = np.add.reduceat(counts, leaf_starts)
+    leaf_avgs = np.add.reduceat(ysums, leaf_starts) / leaf_sizes
+
+    keep_leaf = ncats_in_leaf >= 2
+    ignored = int(np.sum(leaf_sizes[~keep_leaf]))
+    keep = np.repeat(keep_leaf, ncats_in_leaf)
+    col = (np.cumsum(keep_leaf) - 1)[np.cumsum(new_leaf) - 1][keep] # renumber kept leaves 0..m-1
+    # record avg y value per cat above avg y in its leaf
+    delta_y_per_cat = (ysums / counts - np.repeat(leaf_avgs, ncats_in_leaf))[keep]
+    cats, counts = cats[keep], counts[keep]
+
+    # CSR wants entries sorted by row (category) then column (leaf)
+    order = np.lexsort((col, cats))
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(cats, minlength=ncats))])
+    shape = (ncats, int(np.sum(keep_leaf)))
+    leaf_histos = csr_matrix((delta_y_per_cat[order], col[order], indptr), shape=shape)
+    leaf_catcounts = csr_matrix((counts[order], col[order], indptr), shape=shape)
+    return leaf_histos, leaf_avgs[keep_leaf], leaf_sizes[keep_leaf], leaf_catcounts, ignored
+
+
+def avg_per_category(leaf_histos, leaf_catcounts, use_weighted_avg=False):
+    """
+    Average the per-leaf category y deltas from catwise_leaves() across
+    leaves for each category (row), optionally weighting each leaf's delta
+    by the number of observations behind it. Only stored entries count;
+    categories found in no leaf get NaN. Works directly on the sparse
+    structure, never densifying.
+    """
+    ncats = leaf_histos.shape[0]
+    row = np.repeat(np.arange(ncats), np.diff(leaf_histos.indptr))
+    if use_weighted_avg:
+        weights = leaf_catcounts.data.astype(float)
+    else:
+        weights = np.ones(len(leaf_histos.data))
+    sum_per_cat = np.bincount(row, weights=leaf_histos.data * weights, minlength=ncats)
+    weight_per_cat = np.bincount(row, weights=weights, minlength=ncats)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return sum_per_cat / weight_per_cat
+
+
+class CatStratPDResult:
+    """
+    Everything CatStratPD computes for one categorical column, without any
+    plotting. catcodes and catnames, from getcats(), are the categories to
+    report and avg_per_cat[i] is the average change in y for catcodes[i]
+    (NaN if never seen in a usable leaf). deltas is avg_per_cat shifted so
+    the lowest category is 0, which is what the plot shows before sorting.
+
+    leaf_histos and leaf_catcounts rows are dense category indexes
+    0..len(uniq_cats)-1 where uniq_cats are the codes present in X[colname];
+    cat_rows[i] is the row for catcodes[i] or -1 if it's absent from X.
+    timings maps each pipeline stage name to the seconds it took.
+    """
+    def __init__(self, colname, catcodes, catnames, avg_per_cat,
+                 leaf_histos, leaf_avgs, leaf_sizes, leaf_catcounts, ignored,
+                 uniq_cats=None, cat_rows=None, timings=None):
+        self.colname = colname
+        self.catcodes = catcodes
+        self.catnames = catnames
+        self.avg_per_cat = avg_per_cat
+        self.leaf_histos = leaf_histos
+        self.leaf_avgs = leaf_avgs
+        self.leaf_sizes = leaf_sizes
+        self.leaf_catcounts = leaf_catcounts
+        self.ignored = ignored
+        self.uniq_cats = uniq_cats
+        self.cat_rows = cat_rows
+        self.timings = timings
+        # The category y deltas straddle 0 but it's easier to understand if we normalize
+        # so lowest y delta is 0
+        self.min_avg_value = np.nanmin(avg_per_cat)
+        self.deltas = avg_per_cat - self.min_avg_value
+
+
+def factorize_cats(col:pd.Series):
+    """
+    Map the category codes in col to a dense 0..k-1 index where k is the
+    number of distinct codes. Returns (index per observation, uniq_cats)
+    where uniq_cats[i] is the code mapped to i, in increasing order. If col
+    is already a pandas Categorical, its codes are used as-is (no copy) and
+    uniq_cats is 0..len(categories)-1, i.e., the categorical codes.
+    Missing categories are rejected; see reject_missing_cats().
+    """
+    reject_missing_cats(col)
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        return col.cat.codes.values, np.arange(len(col.cat.categories))
+    return pd.factorize(col, sort=True)
+
+
+def reject_missing_cats(col:pd.Series):
+    "Raise ValueError if col has missing values, which would otherwise become category code -1"
+    nmissing = int(col.isna().sum())
+    if nmissing > 0:
+        raise ValueError(f"Categorical column {col.name} has {nmissing} missing values; "
+                         "drop those rows or fill them with their own category")
+
+
+# only works for ints, not floats
+def catstratpd(X, y,
+               colname,  # X[colname] expected to be numeric codes or pandas Categorical
+               catnames=None,  # see plot_catstratpd()
+               ntrees=1,
+               min_samples_leaf=10,
+               max_features=1.0,
+               bootstrap=False,
+               supervised=True,
+               use_weighted_avg=False,
+               verbose=False,
+               cache:'StratCache'=None) -> CatStratPDResult:
+    """
+    Compute, but do not plot, the CatStratPD per-category deltas of y for
+    categorical X[colname]. Never touches matplotlib; see plot_catstratpd().
+    Codes are factorized to a dense index first so sparse or very large
+    codes (e.g., IDs) cost nothing for the codes that are not used.
+    With a StratCache, a repeated call on the same data returns the cached
+    result; see StratCache.
+    """
+    params = dict(ntrees=ntrees, min_samples_leaf=min_samples_leaf, bootstrap=bootstrap,
+                  max_features=max_features, supervised=supervised)
+
+    def deltas(leaves, timings):
+        return catstratpd_deltas(X[colname], np.asarray(y), leaves, catnames=catnames,
+                                 use_weighted_avg=use_weighted_avg,
+                                 verbose=verbose, timings=timings)
+
+    if cache is not None:
+        kind = ('catstratpd', catnames_key(catnames), use_weighted_avg)
+        return cache.result(kind, X, y, colname, params, deltas, verbose=verbose)
+    timings = {}
+    X_not_c, rf, leaves = stratify(X, y, colname, verbose=verbose, timings=timings, **params)
+    return deltas(leaves, timings)
+
+
+def catstratpd_deltas(col:pd.Series, y:np.ndarray, leaves:LeafIndex,
+                      catnames=None,
+                      use_weighted_avg=False,
+                      verbose=False,
+                      timings=None,
+                      xy_sums=None) -> CatStratPDResult:
+    """
+    The part of catstratpd() after stratification: given categorical column
+    col (named), y and the leaves of the stratification forest, compute the
+    per-leaf category deltas and average them per category. Pass the
+    leaf_xy_sums() of the leaves over factorize_cats(col) codes as xy_sums
+    instead if already computed.
+    """
+    if timings is None:
+        timings = {}
+    colname = col.name
+    reject_missing_cats(col)
+
+    catcodes, _, catcode2name = getcats(col.to_frame(), colname, catnames)
+
+    with timed(timings, 'group', colname=colname) as counters:
+        cats, uniq_cats = factorize_cats(col)
+        if xy_sums is None:
+            xy_sums = leaf_xy_sums(leaves, cats, y)
+            counters.update(groups=len(xy_sums[0]), nbytes=sum(a.nbytes for a in xy_sums))
+    return catstratpd_from_sums(xy_sums, uniq_cats, catcodes, catcode2name, colname,
+                                use_weighted_avg=use_weighted_avg, verbose=verbose,
+                                timings=timings)
+
+
+def catstratpd_from_sums(xy_sums, uniq_cats, catcodes, catcode2name, colname=None,
+                         use_weighted_avg=False,
+                         verbose=False,
+                         timings=None) -> CatStratPDResult:
+    """
+    Finish CatStratPD from the per-(leaf, category) sums and counts of
+    leaf_xy_sums() over dense category indexes; uniq_cats[i] is the code
+    of index i (see factorize_cats()) and catcodes, catcode2name come
+    from getcats().
+    """
+    if timings is None:
+        timings = {}
+
+    with timed(timings, 'catwise', colname=colname) as counters:
+        leaf_histos, leaf_avgs, leaf_sizes, leaf_catcounts, ignored = \
+            catwise_sums(*xy_sums, ncats=len(uniq_cats))
+        counters.update(leaves=leaf_histos.shape[1], deltas=leaf_histos.nnz, ignored=ignored)
+
+    if verbose:
+        print(f"CatStratPD Num samples ignored {ignored} for {colname}")
+
+    with timed(timings, 'average', colname=colname, cats=len(uniq_cats)):
+        avg_per_uniq_cat = avg_per_category(leaf_histos, leaf_catcounts, use_weighted_avg)
+        cat_rows = np.searchsorted(uniq_cats, catcodes)
+        cat_rows[cat_rows==len(uniq_cats)] = 0
+        cat_rows[uniq_cats[cat_rows] != catcodes] = -1
+        avg_per_cat = np.where(cat_rows >= 0, avg_per_uniq_cat[cat_rows], np.nan)
+
+    if verbose:
+        print_timings(timings, f"CatStratPD {colname}")
+    return CatStratPDResult(colname, catcodes, catcode2name[catcodes], avg_per_cat,
+                            leaf_histos, leaf_avgs, leaf_sizes, leaf_catcounts, ignored,
+                            uniq_cats=uniq_cats, cat_rows=cat_rows, timings=timings)
+
+
+def catstratpd_nested(X, y, colname,
+                      min_samples_leaf_values=(2,5,10,20,30),
+                      catnames=None,
+                      ntrees=1,
+                      max_features=1.0,
+                      bootstrap=False,
+                      supervised=True,
+                      use_weighted_avg=False,
+                      verbose=False) -> dict:
+    """
+    Approximate CatStratPD for every min_samples_leaf in
+    min_samples_leaf_values from a single stratification forest; see
+    stratpd_nested() for how that differs from refitting. Returns
+    {min_samples_leaf: CatStratPDResult}.
+    """
+    timings = {}
+    X_not_c, rf, leaves = \
+        stratify(X, y, colname, ntrees=ntrees, min_samples_leaf=min(min_samples_leaf_values),
+                 bootstrap=bootstrap, max_features=max_features,
+                 supervised=supervised, verbose=verbose, timings=timings)
+    y = np.asarray(y)
+    with timed(timings, 'group', colname=colname):
+        cats, _ = factorize_cats(X[colname])
+        xy_sums = leaf_xy_sums(leaves, cats, y)
+    results = {}
+    for msl in min_samples_leaf_values:
+        msl_timings = dict(timings)
+        with timed(msl_timings, 'collapse'):
+            msl_sums = collapse_xy_sums(rf, xy_sums, msl)
+        results[msl] = catstratpd_deltas(X[colname], y, None, catnames=catnames,
+                                         use_weighted_avg=use_weighted_avg, verbose=verbose,
+                                         timings=msl_timings, xy_sums=msl_sums)
+    return results
 
 
 # only works for ints, not floats
@@ -710,64 +1581,71 @@ def plot_catstratpd(X, y,
                     show_xlabel=True,
                     show_ylabel=True,
                     show_xticks=True,
-                    verbose=False):
-
-    if supervised:
-        rf = RandomForestRegressor(n_estimators=ntrees,
-                                   min_samples_leaf=min_samples_leaf,
-                                   bootstrap = bootstrap,
-                                   max_features = max_features,
-                                   oob_score=False)
-        rf.fit(X.drop(colname, axis=1), y)
-        if verbose:
-            print(f"CatStrat Partition RF: missing {colname} training R^2 {rf.score(X.drop(colname, axis=1), y)}")
-    else:
-        print("USING UNSUPERVISED MODE")
-        X_synth, y_synth = conjure_twoclass(X)
-        rf = RandomForestRegressor(n_estimators=ntrees,
-                                   min_samples_leaf=min_samples_leaf,
-                                   bootstrap = bootstrap,
-                                   max_features = max_features,
-                                   oob_score=False)
-        rf.fit(X_synth.drop(colname,axis=1), y_synth)
-
-    catcodes, _, catcode2name = getcats(X, colname, catnames)
-
-    # rf = RandomForestRegressor(n_estimators=ntrees, min_samples_leaf=min_samples_leaf, oob_score=True)
-    rf.fit(X.drop(colname, axis=1), y)
-    # print(f"Model wo {colname} OOB R^2 {rf.oob_score_:.5f}")
-    leaf_histos, leaf_avgs, leaf_sizes, leaf_catcounts, ignored = \
-        catwise_leaves(rf, X, y, colname, verbose=verbose)
-
-    if verbose:
-        print(f"CatStratPD Num samples ignored {ignored} for {colname}")
+                    top_k=None,
+                    bottom_k=None,
+                    verbose=False,
+                    cache:'StratCache'=None):
+    r = catstratpd(X, y, colname, catnames=catnames,
+                   ntrees=ntrees, min_samples_leaf=min_samples_leaf,
+                   max_features=max_features, bootstrap=bootstrap,
+                   supervised=supervised, use_weighted_avg=use_weighted_avg,
+                   verbose=verbose, cache=cache)
+
+    return render_catstratpd(r, targetname, ax=ax, sort=sort, yrange=yrange, title=title,
+                             alpha=alpha, color=color, pdp_marker_size=pdp_marker_size,
+                             marker_size=marker_size, pdp_color=pdp_color, style=style,
+                             show_xlabel=show_xlabel, show_ylabel=show_ylabel,
+                             show_xticks=show_xticks, top_k=top_k, bottom_k=bottom_k)
+
+
+def render_catstratpd(r:CatStratPDResult, targetname,
+                      ax=None,
+                      sort='ascending',
+                      yrange=None,
+                      title=None,
+                      alpha=.15,
+                      color='#2c7fb8',
+                      pdp_marker_size=.5,
+                      marker_size=5,
+                      pdp_color='black',
+                      style:('strip','scatter')='strip',
+                      show_xlabel=True,
+                      show_ylabel=True,
+                      show_xticks=True,
+                      top_k=None,
+                      bottom_k=None):
+    """
+    Draw a CatStratPDResult from catstratpd() onto ax (or a new figure) and
+    return the same (catcodes, sorted names, sorted deltas, ignored) tuple
+    as plot_catstratpd(). With top_k and/or bottom_k, only the categories
+    with the top_k largest and bottom_k smallest deltas are drawn and
+    returned, for columns with too many categories to read. All leaf
+    points go into one scatter and all category averages into one more
+    artist, however many categories there are.
+    """
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import LineCollection
 
-    if use_weighted_avg:
-        weighted_histos = leaf_histos * leaf_catcounts
-        weighted_sum_per_cat = np.nansum(weighted_histos, axis=1)  # sum across columns
-        total_obs_per_cat = np.nansum(leaf_catcounts, axis=1)
-        avg_per_cat = weighted_sum_per_cat / total_obs_per_cat
-    else:
-        avg_per_cat = np.nanmean(leaf_histos, axis=1)
+    start = time.perf_counter()
+    catcodes, catnames = r.catcodes, r.catnames
+    avg_per_cat, leaf_histos = r.avg_per_cat, r.leaf_histos
+    min_avg_value = r.min_avg_value
 
     if ax is None:
         fig, ax = plt.subplots(1, 1)
 
     ncats = len(catcodes)
-    nleaves = len(leaf_histos.columns)
+    nleaves = leaf_histos.shape[1]
 
-    sorted_catcodes = catcodes
+    # positions into catcodes, catnames, avg_per_cat
+    sorted_indexes = np.arange(ncats)
     if sort == 'ascending':
-        sorted_indexes = avg_per_cat[~np.isnan(avg_per_cat)].argsort()
-        sorted_catcodes = catcodes[sorted_indexes]
+        sorted_indexes = avg_per_cat.argsort()
     elif sort == 'descending':
         sorted_indexes = avg_per_cat.argsort()[::-1]  # reversed
-        sorted_catcodes = catcodes[sorted_indexes]
-
-
-    # The category y deltas straddle 0 but it's easier to understand if we normalize
-    # so lowest y delta is 0
-    min_avg_value = np.nanmin(avg_per_cat)
+    if top_k is not None or bottom_k is not None:
+        sorted_indexes = sorted_indexes[np.isin(sorted_indexes, extreme_cats(avg_per_cat, top_k, bottom_k))]
+    nshown = len(sorted_indexes)
 
     # print(leaf_histos.iloc[np.nonzero(catcounts)])
     # # print(leaf_histos.notna().multiply(leaf_sizes, axis=1))
@@ -779,34 +1657,40 @@ def plot_catstratpd(X, y,
     # print(f"Avg per cat: {list(avg_per_cat[~np.isnan(avg_per_cat)]-min_avg_value)}")
 
     # if too many categories, can't do strip plot
-    xloc = 0
     sigma = .02
     mu = 0
     if style == 'strip':
         x_noise = np.random.normal(mu, sigma, size=nleaves) # to make strip plot
     else:
         x_noise = np.zeros(shape=(nleaves,))
-    for cat in sorted_catcodes:
-        if catcode2name[cat] is None: continue
-        ax.scatter(x_noise + xloc, leaf_histos.iloc[cat] - min_avg_value,
-                   alpha=alpha, marker='o', s=marker_size,
-                   c=color)
-        if style == 'strip':
-            ax.plot([xloc - .1, xloc + .1], [avg_per_cat[cat]-min_avg_value] * 2,
-                    c='black', linewidth=2)
-        else:
-            ax.scatter(xloc, avg_per_cat[cat]-min_avg_value, c=pdp_color, s=pdp_marker_size)
-        xloc += 1
 
-    ax.set_xticks(range(0, ncats))
+    # gather every shown category's row of leaf_histos at once; category i
+    # goes at x location xlocs[i], its position in sorted_indexes
+    cats = r.cat_rows[sorted_indexes]
+    starts = np.where(cats >= 0, leaf_histos.indptr[np.maximum(cats, 0)], 0)
+    lens = np.where(cats >= 0, leaf_histos.indptr[np.maximum(cats, 0) + 1] - starts, 0)
+    entries = np.repeat(starts - np.cumsum(lens) + lens, lens) + np.arange(lens.sum())
+    xlocs = np.arange(nshown)
+    ax.scatter(np.repeat(xlocs, lens) + x_noise[leaf_histos.indices[entries]],
+               leaf_histos.data[entries] - min_avg_value,
+               alpha=alpha, marker='o', s=marker_size,
+               c=color)
+    avg_y = avg_per_cat[sorted_indexes] - min_avg_value
+    if style == 'strip':
+        bars = np.stack([np.column_stack([xlocs - .1, avg_y]), np.column_stack([xlocs + .1, avg_y])], axis=1)
+        ax.add_collection(LineCollection(bars, colors='black', linewidths=2))
+    else:
+        ax.scatter(xlocs, avg_y, c=pdp_color, s=pdp_marker_size)
+
+    ax.set_xticks(range(0, nshown))
     if show_xticks: # sometimes too many
-        ax.set_xticklabels(catcode2name[sorted_catcodes])
+        ax.set_xticklabels(catnames[sorted_indexes])
     else:
         ax.set_xticklabels([])
         ax.tick_params(axis='x', which='both', bottom=False)
 
     if show_xlabel:
-        ax.set_xlabel(colname)
+        ax.set_xlabel(r.colname)
     if show_ylabel:
         ax.set_ylabel(targetname)
     if title is not None:
@@ -815,45 +1699,864 @@ def plot_catstratpd(X, y,
     if yrange is not None:
         ax.set_ylim(*yrange)
 
-    ycats = avg_per_cat[sorted_catcodes] - min_avg_value
-    return catcodes, catcode2name[sorted_catcodes], ycats, ignored
+    ycats = avg_per_cat[sorted_indexes] - min_avg_value
+    emit('render', time.perf_counter() - start, colname=r.colname, cats=nshown, points=len(entries))
+    return catcodes, catnames[sorted_indexes], ycats, r.ignored
+
+
+def extreme_cats(avg_per_cat:np.ndarray, top_k=None, bottom_k=None) -> np.ndarray:
+    """
+    Return the sorted positions of the top_k largest and bottom_k smallest
+    non-nan values of avg_per_cat; all positions if both are None.
+    """
+    if top_k is None and bottom_k is None:
+        return np.arange(len(avg_per_cat))
+    by_avg = np.flatnonzero(~np.isnan(avg_per_cat))
+    by_avg = by_avg[np.argsort(avg_per_cat[by_avg], kind='stable')]
+    keep = [by_avg[:bottom_k or 0], by_avg[len(by_avg) - min(top_k or 0, len(by_avg)):]]
+    return np.unique(np.concatenate(keep))
 
 
 def getcats(X, colname, incoming_cats):
+    """
+    Return (catcodes, catnames, catcode2name) for X[colname] given catnames
+    as None (use the codes themselves, or the categories of a pandas
+    Categorical), a dict mapping code to name, or a 0-indexed list of names
+    where None marks an unused code. catcode2name is indexed by code.
+    """
     if incoming_cats is None or isinstance(incoming_cats, pd.Series):
-        catcodes = np.unique(X[colname])
-        catcode2name = [None] * (max(catcodes) + 1)
-        for c in catcodes:
-            catcode2name[c] = c
-        catcode2name = np.array(catcode2name)
-        catnames = catcodes
+        col = X[colname]
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            catcode2name = np.asarray(col.cat.categories, dtype=object)
+            catcodes = np.arange(len(catcode2name))
+        else:
+            catcodes = np.unique(col)
+            catcode2name = np.full(max(catcodes) + 1, None, dtype=object)
+            catcode2name[catcodes] = catcodes
+            if len(catcodes) == len(catcode2name): # dense 0..n-1 so no Nones
+                catcode2name = catcodes
+        catnames = catcode2name[catcodes]
     elif isinstance(incoming_cats, dict):
-        catnames_ = [None] * (max(incoming_cats.keys()) + 1)
-        catcodes = []
-        catnames = []
-        for code, name in incoming_cats.items():
-            catcodes.append(code)
-            catnames.append(name)
-            catnames_[code] = name
-        catcodes = np.array(catcodes)
-        catnames = np.array(catnames)
-        catcode2name = np.array(catnames_)
+        catcodes = np.array(list(incoming_cats.keys()))
+        catnames = np.array(list(incoming_cats.values()))
+        catcode2name = np.full(max(catcodes) + 1, None, dtype=object)
+        catcode2name[catcodes] = catnames
+        if len(catcodes) == len(catcode2name):
+            catcode2name = catcode2name.astype(catnames.dtype)
     elif not isinstance(incoming_cats, dict):
         # must be a list of names then
-        catcodes = []
-        catnames_ = [None] * len(incoming_cats)
-        for cat, c in enumerate(incoming_cats):
-            if c is not None:
-                catcodes.append(cat)
-            catnames_[cat] = c
-        catcodes = np.array(catcodes)
-        catcode2name = np.array(catnames_)
+        catcode2name = np.array(incoming_cats)
+        catcodes = np.flatnonzero(np.array(incoming_cats, dtype=object) != None)
         catnames = np.array(incoming_cats)
     else:
         raise ValueError("catnames must be None, 0-indexed list, or pd.Series")
     return catcodes, catnames, catcode2name
 
 
+class StratCache:
+    """
+    Opt-in, in-memory cache of the expensive StratPD/CatStratPD stages so
+    that re-plotting the same data with different cosmetics (yrange, colors,
+    show_slope_lines, ...) skips the forest entirely. Pass one instance as
+    cache= to stratpd(), catstratpd(), plot_stratpd() or plot_catstratpd().
+
+    Three levels are held as separate entries, keyed by data_fingerprint(X, y),
+    colname and the stratification hyperparameters: the fitted forest, its
+    LeafIndex, and the computed result. A result hit costs a fingerprint; a
+    leaf index hit skips fit and apply; a forest hit skips only the fit.
+    Entries share one LRU order and are evicted least recently used first
+    once their estimated size exceeds max_bytes. hits and misses count
+    lookups per level.
+
+    Fingerprinting hashes every byte of X and y (about 0.4s for 400k x 50
+    floats), so the fingerprint is remembered for the X and y objects
+    themselves and only recomputed if their shapes or a hash of a sample
+    of rows (sampled_fingerprint()) changed. Caveat: an in-place edit of X
+    or y that misses the sampled rows isn't noticed; call clear() after
+    modifying data in place, or pass a copy.
+    """
+    LEVELS = ('forest', 'leaves', 'result')
+
+    def __init__(self, max_bytes:int=512 * 1024**2):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = OrderedDict() # (level, key) -> (value, nbytes)
+        self.fingerprints = {} # (id(X), id(y)) -> (weakref X, weakref y, check, fingerprint)
+        self.hits = dict.fromkeys(self.LEVELS, 0)
+        self.misses = dict.fromkeys(self.LEVELS, 0)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, level, key):
+        entry = self.entries.get((level, key))
+        if entry is None:
+            self.misses[level] += 1
+            return None
+        self.hits[level] += 1
+        self.entries.move_to_end((level, key))
+        return entry[0]
+
+    def put(self, level, key, value):
+        size = estimated_nbytes(value)
+        if size > self.max_bytes:
+            return
+        old = self.entries.pop((level, key), None)
+        if old is not None:
+            self.nbytes -= old[1]
+        self.entries[(level, key)] = (value, size)
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.nbytes -= evicted_size
+
+    def clear(self):
+        self.entries.clear()
+        self.fingerprints.clear()
+        self.nbytes = 0
+
+    def fingerprint(self, X, y) -> str:
+        "data_fingerprint(X, y), remembered per X and y object; see class comment"
+        try:
+            refs = weakref.ref(X), weakref.ref(y)
+        except TypeError: # e.g., y is a list
+            return data_fingerprint(X, y)
+        check = (X.shape, np.shape(y), sampled_fingerprint(X, y))
+        memo = self.fingerprints.get((id(X), id(y)))
+        if memo is not None and memo[0]() is X and memo[1]() is y and memo[2] == check:
+            return memo[3]
+        fingerprint = data_fingerprint(X, y)
+        # forget frames that have been garbage collected; their ids can be reused
+        self.fingerprints = {k: m for k, m in self.fingerprints.items()
+                             if m[0]() is not None and m[1]() is not None}
+        self.fingerprints[(id(X), id(y))] = (*refs, check, fingerprint)
+        return fingerprint
+
+    def stratify(self, X, y, colname, fingerprint, params:dict, verbose=False, timings=None):
+        "stratify() through the forest and leaf index levels; returns leaves"
+        if timings is None:
+            timings = {}
+        key = (fingerprint, colname, tuple(sorted(params.items())))
+        leaves = self.get('leaves', key)
+        if leaves is not None:
+            return leaves
+        X_not_c = drop_column(X, colname, timings)
+        rf = self.get('forest', key)
+        if rf is None:
+            rf, leaves = fit_stratifier(X_not_c, y, colname=colname, verbose=verbose,
+                                        timings=timings, **params)
+            self.put('forest', key, rf)
+        else:
+            with timed(timings, 'apply'):
+                leaves = leaf_samples(rf, X_not_c)
+        self.put('leaves', key, leaves)
+        return leaves
+
+    def result(self, kind, X, y, colname, params:dict, compute, verbose=False):
+        """
+        Return the cached result of kind for X, y, colname and params, or
+        call compute(leaves, timings) with the (possibly cached) leaves and
+        cache what it returns. kind must be hashable and identify everything
+        that compute depends on beyond the stratification.
+        """
+        timings = {}
+        with timed(timings, 'fingerprint'):
+            fingerprint = self.fingerprint(X, y)
+        key = (kind, fingerprint, colname, tuple(sorted(params.items())))
+        r = self.get('result', key)
+        if r is not None:
+            return r
+        leaves = self.stratify(X, y, colname, fingerprint, params, verbose, timings)
+        r = compute(leaves, timings)
+        self.put('result', key, r)
+        return r
+
+
+def data_fingerprint(X:pd.DataFrame, y) -> str:
+    """
+    Fast content hash of X and y for StratCache keys: column names, dtypes
+    and the raw bytes of numeric columns (pandas' vectorized row hashes for
+    anything else), run through blake2b. Any change to the data changes it.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr(X.shape).encode())
+    for colname in X.columns:
+        col = X[colname]
+        h.update(f"{colname}:{col.dtype}".encode())
+        values = col.values
+        if isinstance(values, np.ndarray) and values.dtype.kind in 'biufcmM':
+            h.update(np.ascontiguousarray(values).view(np.uint8))
+        else:
+            h.update(pd.util.hash_pandas_object(col, index=False).values)
+    y = np.asarray(y)
+    h.update(f"y:{y.dtype}".encode())
+    h.update(np.ascontiguousarray(y).view(np.uint8) if y.dtype.kind in 'biufc'
+             else pd.util.hash_pandas_object(pd.Series(y), index=False).values)
+    return h.hexdigest()
+
+
+def sampled_fingerprint(X:pd.DataFrame, y, nrows:int=1024) -> str:
+    "data_fingerprint() of at most about nrows evenly spaced rows of X and y"
+    step = max(1, len(X) // nrows)
+    return data_fingerprint(X.iloc[::step], np.asarray(y)[::step])
+
+
+def estimated_nbytes(obj) -> int:
+    "Approximate memory held by a forest, LeafIndex or result object"
+    from scipy.sparse import csr_matrix
+    from sklearn.ensemble import RandomForestRegressor
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, csr_matrix):
+        return obj.data.nbytes + obj.indices.nbytes + obj.indptr.nbytes
+    if isinstance(obj, RandomForestRegressor):
+        # sklearn's Node struct is 64 bytes, plus each node's value array
+        return sum(t.tree_.node_count * 64 + t.tree_.value.nbytes for t in obj.estimators_)
+    if isinstance(obj, (list, tuple)):
+        return sum(estimated_nbytes(o) for o in obj)
+    if isinstance(obj, dict):
+        return sum(estimated_nbytes(o) for o in obj.values())
+    if hasattr(obj, '__dict__'):
+        return estimated_nbytes(vars(obj))
+    return 0
+
+
+def catnames_key(catnames):
+    "Hashable stand-in for a catnames argument (None, dict, Series or sequence)"
+    if catnames is None:
+        return None
+    if isinstance(catnames, (dict, pd.Series)):
+        return tuple(catnames.items())
+    return tuple(catnames)
+
+
+class StratSums:
+    """
+    Mergeable, serializable per-(leaf, x) sums and counts of y for column
+    colname: everything StratPD needs (x numeric) or CatStratPD needs (x
+    category codes) once the stratification forest is fixed. Accumulate
+    shards of a dataset separately, in other processes or on other
+    machines, with from_data() and the same forest, then merge() them.
+    merge() is associative and commutative, and merging all shards gives
+    the same result as a single pass over all the data (up to floating
+    point summation order).
+
+    For categorical columns, xs holds the raw codes (pandas Categorical
+    codes, with the categories kept in categories) so shards agree on what
+    a code means. forest is a fingerprint of the stratification forest;
+    merging sums from different forests raises ValueError. n is the number
+    of rows accumulated. Use save()/load() or pickle to ship them around.
+    """
+    def __init__(self, colname, leaf_keys, xs, ysums, counts, n=0,
+                 forest=None, categories=None):
+        self.colname = colname
+        self.leaf_keys = leaf_keys
+        self.xs = xs
+        self.ysums = ysums
+        self.counts = counts
+        self.n = n
+        self.forest = forest
+        self.categories = categories
+
+    @classmethod
+    def from_data(cls, rf, X:pd.DataFrame, y, colname, categorical=False) -> 'StratSums':
+        """
+        Push the rows of X (same columns as the data rf stratified, colname
+        included) through rf and sum y per (leaf, X[colname]) value.
+        """
+        X_not_c = drop_column(X, colname)
+        x, categories = cls.column_values(X[colname], categorical)
+        sums = forest_xy_sums(rf, X_not_c, x, y)
+        return cls(colname, *sums, n=len(X), forest=forest_fingerprint(rf),
+                   categories=categories)
+
+    @staticmethod
+    def column_values(col:pd.Series, categorical=False):
+        "The x values to sum over for col and its categories (if a pandas Categorical)"
+        if categorical and isinstance(col.dtype, pd.CategoricalDtype):
+            reject_missing_cats(col)
+            return col.cat.codes.values, np.asarray(col.cat.categories)
+        return col.values, None
+
+    @property
+    def xy_sums(self):
+        return self.leaf_keys, self.xs, self.ysums, self.counts
+
+    def __neg__(self):
+        "Sums that, merged, remove these rows: a.merge(-b) is a without b's rows"
+        return StratSums(self.colname, self.leaf_keys, self.xs, -self.ysums, -self.counts,
+                         n=-self.n, forest=self.forest, categories=self.categories)
+
+    def merge(self, other:'StratSums') -> 'StratSums':
+        """
+        Return new sums covering the rows of both self and other. Groups
+        whose count drops to zero, when other is negated, are dropped.
+        """
+        if self.colname != other.colname or self.forest != other.forest:
+            raise ValueError("Can only merge sums of the same column from the same forest")
+        if (self.categories is None) != (other.categories is None) or \
+                (self.categories is not None and not np.array_equal(self.categories, other.categories)):
+            raise ValueError(f"Categories of {self.colname} differ between sums")
+        sums = merge_xy_sums(*[np.concatenate(pair) for pair in zip(self.xy_sums, other.xy_sums)])
+        if np.any(sums[3] == 0):
+            sums = tuple(a[sums[3] != 0] for a in sums)
+        return StratSums(self.colname, *sums, n=self.n + other.n,
+                         forest=self.forest, categories=self.categories)
+
+    def stratpd(self, verbose=False) -> StratPDResult:
+        return stratpd_from_sums(self.xy_sums, self.colname, verbose=verbose, n=self.n)
+
+    def catstratpd(self, catnames=None, use_weighted_avg=False, verbose=False) -> CatStratPDResult:
+        "See catstratpd(); catnames defaults to the categories of a Categorical column"
+        uniq_cats, cats = np.unique(self.xs, return_inverse=True)
+        if catnames is None and self.categories is not None:
+            catnames = list(self.categories)
+        codes = pd.DataFrame({self.colname: uniq_cats})
+        catcodes, _, catcode2name = getcats(codes, self.colname, catnames)
+        return catstratpd_from_sums((self.leaf_keys, cats, self.ysums, self.counts),
+                                    uniq_cats, catcodes, catcode2name, self.colname,
+                                    use_weighted_avg=use_weighted_avg, verbose=verbose)
+
+    def save(self, file):
+        """
+        Write to a filename or file object in numpy .npz format; see load().
+        colname is stored with its type so it must be a str or number.
+        """
+        colname = np.array(self.colname)
+        if colname.ndim != 0 or colname.dtype.kind not in 'biufU':
+            raise ValueError(f"Can't save sums of column {self.colname!r}; name must be a str or number")
+        extra = {} if self.categories is None else {'categories': self.categories.astype(str)}
+        if self.forest is not None:
+            extra['forest'] = np.array(self.forest)
+        np.savez(file, leaf_keys=self.leaf_keys, xs=self.xs, ysums=self.ysums, counts=self.counts,
+                 colname=colname, n=np.array(self.n), **extra)
+
+    @classmethod
+    def load(cls, file) -> 'StratSums':
+        "Read sums written by save(); Categorical categories come back as strings"
+        with np.load(file, allow_pickle=False) as f:
+            return cls(f['colname'].item(), f['leaf_keys'], f['xs'], f['ysums'], f['counts'],
+                       n=int(f['n']), forest=f['forest'].item() if 'forest' in f else None,
+                       categories=f['categories'] if 'categories' in f else None)
+
+
+class StratPD:
+    """
+    StratPD for data that keeps arriving. fit() grows the stratification
+    forest and accumulates per-(leaf, x) sums (StratSums); partial_update()
+    pushes new rows through that same forest and revises only the leaves
+    they land in and remove() takes rows back out (e.g., to slide a window
+    over time; see window_drift()). The forest is refit only when you call
+    fit() again, with all the data you want it to see. pdpx, pdpy is the
+    current curve and result() gives the full StratPDResult, e.g., for
+    render_stratpd().
+
+    The average slope at each unique x is kept as difference arrays (see
+    avg_values_at_x()): running sums of the leaf slopes, and of the number
+    of slopes, that start minus those that end at each x. An update removes
+    the old slopes of the affected leaves and adds their new ones, so its
+    cost is proportional to the rows and leaves it touches; re-emitting
+    the curve is a cumulative sum over the unique x values. x values whose
+    rows have all been removed drop out of the curve. Because the
+    sums are updated in place rather than recomputed, pdpy can differ from
+    a from-scratch stratpd() on the same forest by floating-point rounding.
+    """
+    def __init__(self, colname,
+                 ntrees=1, min_samples_leaf=10, bootstrap=False,
+                 max_features=1.0,
+                 supervised=True,
+                 verbose=False):
+        self.colname = colname
+        self.params = dict(ntrees=ntrees, min_samples_leaf=min_samples_leaf, bootstrap=bootstrap,
+                           max_features=max_features, supervised=supervised)
+        self.verbose = verbose
+        self.categorical = False
+        self.rf = None
+        self.sums = None
+
+    def fit(self, X:pd.DataFrame, y) -> 'StratPD':
+        "(Re)fit the stratification forest to X, y and start over from just that data"
+        X_not_c, self.rf, leaves = stratify(X, y, self.colname, verbose=self.verbose, **self.params)
+        x, categories = StratSums.column_values(X[self.colname], self.categorical)
+        self.sums = StratSums(self.colname, *leaf_xy_sums(leaves, x, np.asarray(y)), n=len(X),
+                              forest=forest_fingerprint(self.rf), categories=categories)
+        self._start()
+        return self
+
+    def partial_update(self, X_new:pd.DataFrame, y_new) -> 'StratPD':
+        "Add rows X_new, y_new (same columns as fit() data) without refitting the forest"
+        if self.rf is None:
+            raise ValueError("Call fit() before partial_update()")
+        self._update(StratSums.from_data(self.rf, X_new, y_new, self.colname, self.categorical))
+        return self
+
+    def remove(self, X_old:pd.DataFrame, y_old) -> 'StratPD':
+        "Take out rows X_old, y_old previously added by fit() or partial_update()"
+        if self.rf is None:
+            raise ValueError("Call fit() before remove()")
+        self._update(-StratSums.from_data(self.rf, X_old, y_old, self.colname, self.categorical))
+        return self
+
+    def snapshot(self):
+        "What window_drift() records per window: (pdpx, pdpy)"
+        return self.curve()
+
+    def distance(self, a, b) -> float:
+        return curve_distance(*a, *b)
+
+    @property
+    def n(self):
+        return self.sums.n
+
+    @property
+    def pdpx(self):
+        return self.curve()[0]
+
+    @property
+    def pdpy(self):
+        return self.curve()[1]
+
+    def curve(self):
+        "Current (pdpx, pdpy)"
+        nx = len(self.uniq_x)
+        nslopes = np.cumsum(self.nslope_diffs)[:nx]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope_at_x = np.cumsum(self.slope_diffs)[:nx] / nslopes
+        slope_at_x[nslopes==0] = np.nan
+        return integrate_slopes(self.uniq_x, slope_at_x)
+
+    def result(self) -> StratPDResult:
+        leaf_xranges, leaf_sizes, leaf_slopes, ignored = discrete_slopes(*self.sums.xy_sums)
+        pdpx, pdpy = self.curve()
+        return StratPDResult(self.colname, leaf_xranges, leaf_slopes, pdpx, pdpy, self.ignored,
+                             domain=(self.uniq_x[0], self.uniq_x[-1]), leaf_sizes=leaf_sizes)
+
+    def _update(self, batch:StratSums):
+        "Fold batch sums (negated to remove rows) into the affected leaves"
+        sums = self.sums
+        leaves = np.unique(batch.leaf_keys)
+        idx = leaf_group_indexes(sums.leaf_keys, leaves)
+        old = tuple(a[idx] for a in sums.xy_sums)
+        new = StratSums(sums.colname, *old, forest=sums.forest, categories=sums.categories)
+        new = new.merge(StratSums(sums.colname, *batch.xy_sums, forest=batch.forest,
+                                  categories=batch.categories)).xy_sums
+        self._revise(old, new, batch)
+
+        # replace the affected leaves' groups; both sides are sorted by leaf
+        kept = [np.delete(a, idx) for a in sums.xy_sums]
+        at = np.searchsorted(kept[0], new[0])
+        self.sums = StratSums(sums.colname, *[np.insert(k, at, a) for k, a in zip(kept, new)],
+                              n=sums.n + batch.n, forest=sums.forest, categories=sums.categories)
+
+    def _start(self):
+        "Derive the slope difference arrays from scratch from self.sums"
+        self.uniq_x, where = np.unique(self.sums.xs, return_inverse=True)
+        self.x_counts = np.bincount(where, weights=self.sums.counts,
+                                    minlength=len(self.uniq_x)).astype(np.int64)
+        self.slope_diffs = np.zeros(len(self.uniq_x) + 1)
+        self.nslope_diffs = np.zeros(len(self.uniq_x) + 1, dtype=np.int64)
+        leaf_xranges, _, leaf_slopes, self.ignored = discrete_slopes(*self.sums.xy_sums)
+        self._add_slopes(leaf_xranges, leaf_slopes, 1)
+
+    def _revise(self, old, new, batch:StratSums):
+        "Swap the slopes of the affected leaves' old groups for those of their new groups"
+        self._insert_x(batch.xs)
+        np.add.at(self.x_counts, np.searchsorted(self.uniq_x, batch.xs), batch.counts)
+        old_xranges, _, old_slopes, old_ignored = discrete_slopes(*old)
+        new_xranges, _, new_slopes, new_ignored = discrete_slopes(*new)
+        self._add_slopes(old_xranges, old_slopes, -1)
+        self._add_slopes(new_xranges, new_slopes, 1)
+        self.ignored += new_ignored - old_ignored
+        if np.any(self.x_counts == 0):
+            self._drop_unused_x()
+
+    def _insert_x(self, xs):
+        "Add any x values not seen before; a zero difference leaves coverage of neighbors as is"
+        nx = len(self.uniq_x)
+        at = np.searchsorted(self.uniq_x, xs)
+        seen = np.zeros(len(xs), dtype=bool)
+        inrange = at < nx
+        seen[inrange] = self.uniq_x[at[inrange]] == xs[inrange]
+        new_x = np.unique(xs[~seen])
+        if len(new_x) == 0:
+            return
+        at = np.searchsorted(self.uniq_x, new_x)
+        self.uniq_x = np.insert(self.uniq_x, at, new_x)
+        self.x_counts = np.insert(self.x_counts, at, 0)
+        self.slope_diffs = np.insert(self.slope_diffs, at, 0.0)
+        self.nslope_diffs = np.insert(self.nslope_diffs, at, 0)
+
+    def _drop_unused_x(self):
+        "Forget x values with no rows left, keeping coverage of the rest the same"
+        used = self.x_counts != 0
+        keep = np.append(used, True) # sentinel difference at the end
+        self.uniq_x, self.x_counts = self.uniq_x[used], self.x_counts[used]
+        # diffs at dropped x (zero, up to rounding) go to the next kept x
+        self.slope_diffs = np.diff(np.cumsum(self.slope_diffs)[keep], prepend=0.0)
+        self.nslope_diffs = np.diff(np.cumsum(self.nslope_diffs)[keep], prepend=0)
+
+    def _add_slopes(self, leaf_xranges, leaf_slopes, sign):
+        "Add (sign=1) or remove (sign=-1) slopes over [x0, x1) like avg_values_at_x()"
+        ok = ~np.isnan(leaf_slopes)
+        left = np.searchsorted(self.uniq_x, leaf_xranges[ok, 0])
+        right = np.searchsorted(self.uniq_x, leaf_xranges[ok, 1])
+        np.add.at(self.slope_diffs, left, sign * leaf_slopes[ok])
+        np.add.at(self.slope_diffs, right, -sign * leaf_slopes[ok])
+        np.add.at(self.nslope_diffs, left, sign)
+        np.add.at(self.nslope_diffs, right, -sign)
+
+
+class CatStratPD(StratPD):
+    """
+    The CatStratPD counterpart of StratPD: a stateful CatStratPD with
+    fit(), partial_update() and remove() that only revisit the leaves the
+    rows land in. For every category code seen so far it keeps the running
+    (weighted) sum of its per-leaf y deltas and the sum of their weights,
+    the numerator and denominator of avg_per_category(); a category whose
+    rows have all been removed stays, with NaN. deltas is the current
+    per-category change in y, as a Series indexed by category name, and
+    result() gives the full CatStratPDResult for render_catstratpd().
+    """
+    def __init__(self, colname,
+                 catnames=None,
+                 ntrees=1, min_samples_leaf=10, bootstrap=False,
+                 max_features=1.0,
+                 supervised=True,
+                 use_weighted_avg=False,
+                 verbose=False):
+        super().__init__(colname, ntrees=ntrees, min_samples_leaf=min_samples_leaf,
+                         bootstrap=bootstrap, max_features=max_features,
+                         supervised=supervised, verbose=verbose)
+        self.catnames = catnames
+        self.use_weighted_avg = use_weighted_avg
+        self.categorical = True
+
+    @property
+    def deltas(self) -> pd.Series:
+        catnames = self.catnames
+        if catnames is None and self.sums.categories is not None:
+            catnames = list(self.sums.categories)
+        codes = pd.DataFrame({self.colname: self.uniq_cats})
+        catcodes, names, _ = getcats(codes, self.colname, catnames)
+        at = np.minimum(np.searchsorted(self.uniq_cats, catcodes), len(self.uniq_cats) - 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            avg_per_cat = self.delta_sums / self.delta_weights
+        # weights of removed deltas cancel exactly but sums leave rounding behind
+        avg_per_cat[self.delta_weights == 0] = np.nan
+        avg_per_cat = np.where(self.uniq_cats[at] == catcodes, avg_per_cat[at], np.nan)
+        return pd.Series(avg_per_cat - np.nanmin(avg_per_cat), index=names, name=self.colname)
+
+    def snapshot(self):
+        "What window_drift() records per window: deltas"
+        return self.deltas
+
+    def distance(self, a, b) -> float:
+        return deltas_distance(a, b)
+
+    def result(self) -> CatStratPDResult:
+        return self.sums.catstratpd(catnames=self.catnames, use_weighted_avg=self.use_weighted_avg)
+
+    def _start(self):
+        self.uniq_cats = np.unique(self.sums.xs)
+        self.delta_sums = np.zeros(len(self.uniq_cats))
+        self.delta_weights = np.zeros(len(self.uniq_cats))
+        self.ignored = self._add_deltas(self.sums.xy_sums, 1)
+
+    def _revise(self, old, new, batch:StratSums):
+        new_cats = np.setdiff1d(batch.xs, self.uniq_cats) # small: only batch codes are new
+        if len(new_cats) > 0:
+            at = np.searchsorted(self.uniq_cats, new_cats)
+            self.uniq_cats = np.insert(self.uniq_cats, at, new_cats)
+            self.delta_sums = np.insert(self.delta_sums, at, 0.0)
+            self.delta_weights = np.insert(self.delta_weights, at, 0.0)
+        self.ignored += self._add_deltas(new, 1) - self._add_deltas(old, -1)
+
+    def _add_deltas(self, xy_sums, sign) -> int:
+        "Add (sign=1) or remove (sign=-1) the per-leaf deltas of xy_sums; returns ignored"
+        leaf_keys, codes, ysums, counts = xy_sums
+        uniq, cats = np.unique(codes, return_inverse=True)
+        leaf_histos, _, _, leaf_catcounts, ignored = \
+            catwise_sums(leaf_keys, cats, ysums, counts, ncats=len(uniq))
+        row = np.repeat(np.arange(len(uniq)), np.diff(leaf_histos.indptr))
+        weights = leaf_catcounts.data.astype(float) if self.use_weighted_avg \
+            else np.ones(len(leaf_histos.data))
+        at = np.searchsorted(self.uniq_cats, uniq[row])
+        np.add.at(self.delta_sums, at, sign * leaf_histos.data * weights)
+        np.add.at(self.delta_weights, at, sign * weights)
+        return ignored
+
+
+def window_drift(model:StratPD, batches, window:int):
+    """
+    Slide a window of `window` consecutive batches over batches, an
+    iterable of (X, y) pairs in time order (e.g., one per day), and track
+    how model, a StratPD or CatStratPD, changes. model is fit to the first
+    window; each later step adds the next batch with partial_update() and
+    removes the oldest with remove(), so a step costs time proportional to
+    those two batches, not the window. Returns (snapshots, distances): one
+    snapshot per window ((pdpx, pdpy) for StratPD, the deltas Series for
+    CatStratPD) and distances[i] between snapshots i and i+1 per
+    curve_distance() or deltas_distance().
+    """
+    batches = iter(batches)
+    held = deque(itertools.islice(batches, window))
+    if len(held) < window:
+        raise ValueError(f"Need at least {window} batches")
+    model.fit(pd.concat([X for X, _ in held]), np.concatenate([np.asarray(y) for _, y in held]))
+    snapshots = [model.snapshot()]
+    for X_new, y_new in batches:
+        model.partial_update(X_new, y_new)
+        X_old, y_old = held.popleft()
+        model.remove(X_old, y_old)
+        held.append((X_new, y_new))
+        snapshots.append(model.snapshot())
+    distances = np.array([model.distance(a, b) for a, b in zip(snapshots, snapshots[1:])])
+    return snapshots, distances
+
+
+def curve_distance(pdpx1, pdpy1, pdpx2, pdpy2, npoints=100) -> float:
+    """
+    Root mean squared difference between two partial dependence curves
+    over the x range they share, comparing them at npoints evenly spaced
+    x by linear interpolation. Each curve's mean over that range is
+    subtracted first since only the shape of a PD curve matters, not
+    where it starts. NaN if the curves don't overlap. O(len(pdpx)).
+    """
+    lo, hi = max(pdpx1[0], pdpx2[0]), min(pdpx1[-1], pdpx2[-1])
+    if lo >= hi:
+        return np.nan
+    x = np.linspace(lo, hi, npoints)
+    y1 = np.interp(x, pdpx1, pdpy1)
+    y2 = np.interp(x, pdpx2, pdpy2)
+    d = (y1 - y1.mean()) - (y2 - y2.mean())
+    return float(np.sqrt(np.mean(d * d)))
+
+
+def deltas_distance(deltas1:pd.Series, deltas2:pd.Series) -> float:
+    """
+    Root mean squared difference between two per-category delta Series
+    (e.g., CatStratPD.deltas) over the categories known in both, each
+    centered on its mean there. NaN if there are none in common.
+    """
+    both = pd.concat([deltas1, deltas2], axis=1, join='inner').dropna().to_numpy()
+    if len(both) == 0:
+        return np.nan
+    d = (both[:, 0] - both[:, 0].mean()) - (both[:, 1] - both[:, 1].mean())
+    return float(np.sqrt(np.mean(d * d)))
+
+
+def leaf_group_indexes(leaf_keys, leaves):
+    "Indexes of the (leaf, x) groups of each of leaves in sorted leaf_keys"
+    lo = np.searchsorted(leaf_keys, leaves, side='left')
+    hi = np.searchsorted(leaf_keys, leaves, side='right')
+    sizes = hi - lo
+    starts = np.cumsum(sizes) - sizes
+    return np.repeat(lo - starts, sizes) + np.arange(np.sum(sizes))
+
+
+def forest_fingerprint(rf) -> str:
+    "Hash of the tree structure of rf; equal for the same (or an identical) forest"
+    h = hashlib.blake2b(digest_size=16)
+    for t in rf.estimators_:
+        tree = t.tree_
+        for a in (tree.children_left, tree.children_right, tree.feature, tree.threshold):
+            h.update(np.ascontiguousarray(a).view(np.uint8))
+    return h.hexdigest()
+
+
+def stratpd_stream(source, colname, targetname,
+                   sample_size=100_000,
+                   chunksize=100_000,
+                   ntrees=1, min_samples_leaf=10, bootstrap=False,
+                   max_features=1.0,
+                   supervised=True,
+                   random_state=None,
+                   verbose=False) -> StratPDResult:
+    """
+    StratPD for data too big to hold in memory (along with its copies).
+    source is the path of a .csv, .parquet or .feather file (see
+    read_chunks()) or a function returning a fresh iterable of DataFrame
+    chunks; either way it is read twice. Every column other than colname
+    and targetname is a stratification feature.
+
+    The first pass keeps a uniform random sample of sample_size rows and the
+    stratification forest is fit to that. The second pass pushes each chunk
+    through the forest and accumulates its per-(leaf, x) sums and counts
+    (StratSums); the curve is finished from those.
+    Beyond the sample, memory is one chunk plus one group per distinct
+    (leaf, x) pair, which is small for discrete x but can approach n for a
+    continuous x with (nearly) all unique values; round such x first.
+    """
+    chunks = source if callable(source) else lambda: read_chunks(source, chunksize)
+    timings = {}
+
+    with timed(timings, 'sample'):
+        sample = sample_rows(chunks(), sample_size, random_state=random_state)
+        features = sample.columns[(sample.columns != colname) & (sample.columns != targetname)]
+        X_not_c = sample[features].to_numpy(dtype=np.float32)
+    rf, _ = fit_stratifier(X_not_c, sample[targetname].values, colname=colname,
+                           ntrees=ntrees, min_samples_leaf=min_samples_leaf,
+                           bootstrap=bootstrap, max_features=max_features,
+                           supervised=supervised, verbose=verbose, timings=timings)
+    del sample, X_not_c
+
+    sums = None
+    with timed(timings, 'stream'):
+        for chunk in chunks():
+            chunk_sums = StratSums.from_data(rf, chunk.drop(columns=targetname),
+                                             chunk[targetname].values, colname)
+            sums = chunk_sums if sums is None else sums.merge(chunk_sums)
+    if sums is None:
+        raise ValueError(f"No data in {source}")
+
+    return stratpd_from_sums(sums.xy_sums, colname, verbose=verbose, timings=timings, n=sums.n)
+
+
+def read_chunks(path, chunksize=100_000, columns=None):
+    """
+    Yield DataFrames of at most chunksize rows (optionally just columns)
+    from a CSV, parquet (.parquet, .pq) or feather (.feather, .arrow) file
+    without loading all of it. Parquet and feather need pyarrow.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.parquet', '.pq'):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+    elif ext in ('.feather', '.arrow'):
+        import pyarrow as pa
+        import pyarrow.ipc
+        with pa.memory_map(path) as f:
+            reader = pa.ipc.open_file(f)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                if columns is not None:
+                    batch = batch.select(columns)
+                for start in range(0, batch.num_rows, chunksize):
+                    yield batch.slice(start, chunksize).to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize=chunksize, usecols=columns)
+
+
+def sample_rows(chunks, sample_size:int, random_state=None) -> pd.DataFrame:
+    """
+    Uniform random sample, without replacement, of sample_size rows from an
+    iterable of DataFrame chunks in one pass, holding no more than
+    sample_size rows plus one chunk: give each row a uniform random key and
+    keep the rows with the sample_size smallest keys. Rows stay in file order.
+    """
+    rng = np.random.default_rng(random_state)
+    sample, keys = None, None
+    for chunk in chunks:
+        chunk_keys = rng.random(len(chunk))
+        if sample is None:
+            sample, keys = chunk.reset_index(drop=True), chunk_keys
+        else:
+            sample = pd.concat([sample, chunk], ignore_index=True)
+            keys = np.concatenate([keys, chunk_keys])
+        if len(sample) > sample_size:
+            keep = np.sort(np.argpartition(keys, sample_size)[:sample_size])
+            sample, keys = sample.iloc[keep].reset_index(drop=True), keys[keep]
+    if sample is None:
+        raise ValueError("No data to sample")
+    return sample
+
+
+def stratpd_sweep(X:pd.DataFrame, y, colnames=None, catcolnames=(),
+                  catnames:dict=None,
+                  ntrees=1, min_samples_leaf=10, bootstrap=False,
+                  max_features=1.0,
+                  supervised=True,
+                  use_weighted_avg=False,
+                  n_jobs=None,
+                  tmpdir=None) -> dict:
+    """
+    Compute StratPD for each numeric column in colnames (default: every
+    column not in catcolnames) and CatStratPD for each column in catcolnames.
+    Returns {colname: StratPDResult or CatStratPDResult}. catnames optionally
+    maps a categorical colname to its catnames (see plot_catstratpd()).
+
+    X is converted once to a float32 matrix, the stratification forest's
+    working type. With n_jobs > 1 (-1 means all cores), that matrix, y and
+    the columns of interest are written once to memory-mapped .npy files in a
+    temporary directory (under tmpdir) and worker processes map them
+    read-only, so X is never pickled or copied per task. Each task selects
+    the other p-1 columns from the shared matrix; sklearn needs those as one
+    matrix to fit the forest, so that float32 view is the only per-feature
+    copy, replacing X.drop() plus sklearn's own float32 conversion.
+    """
+    if colnames is None:
+        colnames = [c for c in X.columns if c not in catcolnames]
+    columns = list(colnames) + [c for c in catcolnames if c not in colnames]
+    catcolnames = set(catcolnames)
+    if catnames is None:
+        catnames = {}
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    params = dict(ntrees=ntrees, min_samples_leaf=min_samples_leaf, bootstrap=bootstrap,
+                  max_features=max_features, supervised=supervised)
+
+    tasks = [] # (colname, column index j, categorical?, catnames)
+    for colname in columns:
+        names = catnames.get(colname)
+        col = X[colname]
+        if colname in catcolnames and names is None and isinstance(col.dtype, pd.CategoricalDtype):
+            names = list(col.cat.categories) # we only ship the codes to workers
+        tasks.append((colname, X.columns.get_loc(colname), colname in catcolnames, names))
+
+    def column_values(colname):
+        "Categorical columns travel, and stratify the forest, as their codes"
+        col = X[colname]
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            reject_missing_cats(col)
+            return col.cat.codes.values
+        return col.values
+
+    if n_jobs is None or n_jobs <= 1:
+        X32 = np.empty(X.shape, dtype=np.float32, order='F')
+        for j in range(X.shape[1]):
+            X32[:, j] = column_values(X.columns[j])
+        return {colname: sweep_column(X32, column_values(colname), np.asarray(y), j, colname,
+                                      iscat, names, use_weighted_avg, params)
+                for colname, j, iscat, names in tasks}
+
+    with tempfile.TemporaryDirectory(dir=tmpdir) as dirname:
+        X32 = np.lib.format.open_memmap(os.path.join(dirname, 'X.npy'), mode='w+',
+                                        dtype=np.float32, shape=X.shape, fortran_order=True)
+        for j in range(X.shape[1]):
+            X32[:, j] = column_values(X.columns[j])
+        X32.flush()
+        del X32
+        np.save(os.path.join(dirname, 'y.npy'), np.asarray(y))
+        for colname, j, iscat, names in tasks:
+            np.save(os.path.join(dirname, f'col{j}.npy'), column_values(colname))
+
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = {colname: pool.submit(_sweep_worker, dirname, j, colname,
+                                            iscat, names, use_weighted_avg, params)
+                       for colname, j, iscat, names in tasks}
+            return {colname: f.result() for colname, f in futures.items()}
+
+
+def _sweep_worker(dirname, j, colname, iscat, catnames, use_weighted_avg, params):
+    X32 = np.load(os.path.join(dirname, 'X.npy'), mmap_mode='r')
+    y = np.load(os.path.join(dirname, 'y.npy'), mmap_mode='r')
+    x = np.load(os.path.join(dirname, f'col{j}.npy'), mmap_mode='r')
+    return sweep_column(X32, x, y, j, colname, iscat, catnames, use_weighted_avg, params)
+
+
+def sweep_column(X32, x, y, j, colname, iscat, catnames, use_weighted_avg, params):
+    "StratPD or CatStratPD for column j of shared float32 matrix X32; see stratpd_sweep()"
+    timings = {}
+    with timed(timings, 'drop'):
+        X_not_c = X32[:, np.arange(X32.shape[1]) != j]
+    rf, leaves = fit_stratifier(X_not_c, y, colname=colname, timings=timings, **params)
+    if iscat:
+        return catstratpd_deltas(pd.Series(x, name=colname), y, leaves, catnames=catnames,
+                                 use_weighted_avg=use_weighted_avg, timings=timings)
+    return stratpd_curve(np.asarray(x), y, leaves, colname, timings=timings)
+
+
 # -------------- S U P P O R T ---------------
 
 
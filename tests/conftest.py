@@ -0,0 +1,18 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def synthetic_data(n=1000, seed=1):
+    "X with integer a, continuous b and category codes c 0..7; y depends on all three"
+    rng = np.random.RandomState(seed)
+    X = pd.DataFrame({'a': rng.randint(0, 30, n), 'b': rng.uniform(0, 10, n).round(1),
+                      'c': rng.randint(0, 8, n)})
+    y = pd.Series(2*X['a'] + X['b']**2 + 5*X['c'] + rng.normal(size=n), name='y')
+    return X, y
+
+
+@pytest.fixture
+def data():
+    "synthetic_data(n, seed) factory; call with no arguments for the usual 1000 rows"
+    return synthetic_data
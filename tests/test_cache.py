@@ -0,0 +1,54 @@
+from stratx import partdep
+from stratx.partdep import StratCache, data_fingerprint, stratpd
+
+
+def count_fingerprints(monkeypatch):
+    calls = []
+
+    def counting(X, y):
+        calls.append(len(X))
+        return data_fingerprint(X, y)
+    monkeypatch.setattr(partdep, 'data_fingerprint', counting)
+    return calls
+
+
+def test_result_hit_skips_full_fingerprint(monkeypatch, data):
+    X, y = data(n=5000)
+    cache = StratCache()
+    first = stratpd(X, y, 'a', cache=cache)
+    calls = count_fingerprints(monkeypatch)
+    again = stratpd(X, y, 'a', cache=cache)
+    assert again is first
+    assert cache.hits['result'] == 1
+    assert len(X) not in calls # only sampled rows were hashed
+
+
+def test_equal_copy_hits_cache(data):
+    X, y = data()
+    cache = StratCache()
+    first = stratpd(X, y, 'a', cache=cache)
+    assert stratpd(X.copy(), y.copy(), 'a', cache=cache) is first
+
+
+def test_in_place_edit_of_sampled_row_is_noticed(data):
+    X, y = data()
+    cache = StratCache()
+    first = stratpd(X, y, 'a', cache=cache)
+    X.loc[0, 'b'] += 1
+    second = stratpd(X, y, 'a', cache=cache)
+    assert second is not first
+    assert cache.misses['result'] == 2
+
+
+def test_fingerprint_memo_forgets_collected_frames(data):
+    X, y = data()
+    cache = StratCache()
+    for _ in range(3):
+        Xc = X.copy()
+        cache.fingerprint(Xc, y)
+        del Xc
+    cache.fingerprint(X, y)
+    assert len(cache.fingerprints) == 1
+    cache.clear()
+    assert len(cache.fingerprints) == 0
+    assert cache.fingerprint(X, y) == data_fingerprint(X, y)
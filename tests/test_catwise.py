@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from stratx.partdep import catstratpd, catwise_sums, factorize_cats, fit_stratifier, leaf_xy_sums
+
+
+def loop_catwise_leaves(X, y, colname, leaves):
+    "The old leaf by leaf catwise_leaves() groupby loop"
+    ignored = 0
+    leaf_sizes, leaf_avgs = [], []
+    maxcat = max(np.unique(X[colname]))
+    histos, catcounts = {}, {}
+    Xy = pd.concat([X, y], axis=1)
+    ci = 0
+    for sample in leaves:
+        combined = Xy.iloc[sample]
+        avg_y_per_cat = combined.groupby(colname).mean()[y.name]
+        if len(avg_y_per_cat) < 2:
+            ignored += len(sample)
+            continue
+        catcounts['leaf' + str(ci)] = combined[colname].value_counts()
+        avg_y = np.mean(combined[y.name])
+        leaf_avgs.append(avg_y)
+        histos['leaf' + str(ci)] = avg_y_per_cat - avg_y
+        leaf_sizes.append(len(sample))
+        ci += 1
+    leaf_histos = pd.DataFrame(histos, index=range(0, maxcat+1))
+    leaf_catcounts = pd.DataFrame(catcounts, index=range(0, maxcat+1))
+    return leaf_histos, np.array(leaf_avgs), leaf_sizes, leaf_catcounts, ignored
+
+
+@pytest.mark.parametrize('ntrees,min_samples_leaf', [(1, 2), (1, 10), (3, 5), (2, 40)])
+def test_catwise_sums_match_leaf_loop(ntrees, min_samples_leaf, data):
+    X, y = data()
+    _, leaves = fit_stratifier(X.drop('c', axis=1).values, y.values, 'c',
+                               ntrees=ntrees, min_samples_leaf=min_samples_leaf,
+                               bootstrap=ntrees > 1)
+    histos, avgs, sizes, catcounts, ignored = loop_catwise_leaves(X, y, 'c', leaves)
+    # c codes are 0..7, all present, so they are their own dense indexes
+    leaf_histos, leaf_avgs, leaf_sizes, leaf_catcounts, ignored_ = \
+        catwise_sums(*leaf_xy_sums(leaves, X['c'].values, y.values), ncats=8)
+
+    assert leaf_histos.shape == histos.shape
+    counts = leaf_catcounts.toarray()
+    np.testing.assert_array_equal(counts, catcounts.fillna(0).to_numpy())
+    # categories missing from a leaf are NaN in the old frame, absent in the sparse matrix
+    deltas = np.where(counts > 0, leaf_histos.toarray(), np.nan)
+    np.testing.assert_allclose(deltas, histos.to_numpy(), rtol=1e-9, atol=1e-9)
+    np.testing.assert_allclose(leaf_avgs, avgs, rtol=1e-12)
+    np.testing.assert_array_equal(leaf_sizes, sizes)
+    assert ignored_ == ignored
+    assert min_samples_leaf > 2 or ignored > 0 # some single-category leaves
+
+
+@pytest.mark.parametrize('categorical', [False, True])
+def test_missing_categories_rejected(categorical, data):
+    X, y = data()
+    X['c'] = X['c'].astype(float)
+    X.loc[[3, 7], 'c'] = np.nan
+    if categorical:
+        X['c'] = X['c'].astype('category')
+    with pytest.raises(ValueError, match="2 missing values"):
+        factorize_cats(X['c'])
+    with pytest.raises(ValueError, match="2 missing values"):
+        catstratpd(X, y, 'c')
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from stratx.ice import predict_ice, tree_ice
+
+
+def models():
+    from sklearn.tree import DecisionTreeRegressor
+    from sklearn.ensemble import RandomForestRegressor, ExtraTreesRegressor
+    return [DecisionTreeRegressor(random_state=0),
+            DecisionTreeRegressor(min_samples_leaf=20, random_state=0),
+            RandomForestRegressor(n_estimators=10, random_state=0),
+            ExtraTreesRegressor(n_estimators=10, min_samples_leaf=5, random_state=0)]
+
+
+def predict_each(model, X, colname, linex):
+    "ICE the obvious way: one predict() per grid value"
+    ice = np.empty((len(X), len(linex)))
+    for j, v in enumerate(linex):
+        ice[:, j] = model.predict(X.assign(**{colname: v}))
+    return ice
+
+
+@pytest.mark.parametrize('model', models(), ids=lambda m: type(m).__name__)
+@pytest.mark.parametrize('colname', ['a', 'b'])
+def test_tree_ice_matches_predict(model, colname, data):
+    X, y = data(n=500)
+    model.fit(X, y)
+    c = X.columns.get_loc(colname)
+    trees = getattr(model, 'estimators_', [model])
+    thresholds = np.unique(np.concatenate([t.tree_.threshold[t.tree_.feature == c] for t in trees]))
+    # grid values right on split thresholds as well as between them, unsorted
+    linex = np.concatenate([np.linspace(X[colname].min(), X[colname].max(), 25),
+                            thresholds[::7], [X[colname].min() - 1]])
+    np.random.RandomState(0).shuffle(linex)
+    np.testing.assert_allclose(tree_ice(model, X, colname, linex),
+                               predict_each(model, X, colname, linex), rtol=1e-9, atol=1e-9)
+
+
+def test_predict_ice_engines_agree(data):
+    from sklearn.ensemble import RandomForestRegressor
+    X, y = data(n=500)
+    model = RandomForestRegressor(n_estimators=5, random_state=0).fit(X, y)
+    tree = predict_ice(model, X, 'b', engine='tree')
+    stacked = predict_ice(model, X, 'b', engine='predict', max_bytes=64 * 1024)
+    np.testing.assert_allclose(tree, stacked, rtol=1e-9, atol=1e-9)
+    assert tree.shape == (len(X) + 1, 50)
+
+
+def test_tree_ice_declines_other_models(data):
+    from sklearn.linear_model import LinearRegression
+    X, y = data(n=500)
+    assert tree_ice(LinearRegression().fit(X, y), X, 'a', [1, 2]) is None
+
+
+def test_tree_ice_declines_mismatched_columns(data):
+    from sklearn.ensemble import RandomForestRegressor
+    X, y = data(n=500)
+    model = RandomForestRegressor(n_estimators=5, random_state=0).fit(X, y)
+    assert tree_ice(model, X[['c', 'b', 'a']], 'a', [1, 2]) is None
+    assert tree_ice(model, X.assign(d=1.0), 'a', [1, 2]) is None
+    # fit without column names, only the number of columns can be checked
+    model = RandomForestRegressor(n_estimators=5, random_state=0).fit(X.values, y)
+    assert tree_ice(model, X.assign(d=1.0), 'a', [1, 2]) is None
+
+
+def test_predict_ice_mismatched_columns_raise(data):
+    from sklearn.ensemble import RandomForestRegressor
+    X, y = data(n=500)
+    model = RandomForestRegressor(n_estimators=5, random_state=0).fit(X[['a', 'b']], y)
+    with pytest.raises(ValueError):
+        predict_ice(model, X[['b', 'a']], 'a')
+    with pytest.raises(ValueError):
+        predict_ice(model, X, 'a')
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+
+from stratx.partdep import collect_point_betas, discrete_slopes, discrete_xc_space, \
+    fit_stratifier, leaf_xy_sums
+
+
+def loop_discrete_slopes(X, y, colname, leaves):
+    "The old leaf by leaf collect_discrete_slopes() loop"
+    leaf_slopes, leaf_xranges, leaf_sizes = [], [], []
+    ignored = 0
+    for samples in leaves:
+        leaf_x = X.iloc[samples][colname].values
+        leaf_y = y.iloc[samples].values
+        if np.isclose(np.min(leaf_x), np.max(leaf_x)):
+            ignored += len(leaf_x)
+            continue
+        leaf_xranges_, leaf_sizes_, leaf_slopes_, _, ignored_ = \
+            discrete_xc_space(leaf_x, leaf_y, colname=colname, verbose=False)
+        leaf_slopes.extend(leaf_slopes_)
+        leaf_xranges.extend(leaf_xranges_)
+        leaf_sizes.extend(leaf_sizes_)
+        ignored += ignored_
+    return np.array(leaf_xranges), np.array(leaf_sizes), np.array(leaf_slopes), ignored
+
+
+def loop_point_betas(X, y, colname, leaves, nbins):
+    "The old leaf by leaf, bin by bin collect_point_betas() loop"
+    from sklearn.linear_model import LinearRegression
+    ignored = 0
+    leaf_xranges, leaf_slopes = [], []
+    point_betas = np.full(shape=(len(X),), fill_value=np.nan)
+    for samples in leaves:
+        leaf_x = X.iloc[samples][colname].values
+        leaf_y = y.iloc[samples].values
+        bins = np.linspace(np.min(leaf_x), np.max(leaf_x)+0.0000001, num=nbins+1, endpoint=True)
+        binned_idx = np.digitize(leaf_x, bins)
+        for b in range(1, len(bins)+1):
+            bin_x = leaf_x[binned_idx == b]
+            bin_y = leaf_y[binned_idx == b]
+            if len(bin_x) < 2 or np.isclose(np.min(bin_x), np.max(bin_x)):
+                ignored += len(bin_x)
+                continue
+            lm = LinearRegression()
+            lm.fit(bin_x.reshape(-1, 1), bin_y)
+            obs_idx = samples[np.nonzero((leaf_x>=bins[b-1]) & (leaf_x<bins[b]))]
+            point_betas[obs_idx] = lm.coef_[0]
+            leaf_slopes.append(lm.coef_[0])
+            leaf_xranges.append((np.min(bin_x), np.max(bin_x)))
+    return np.array(leaf_xranges), np.array(leaf_slopes), point_betas, ignored
+
+
+@pytest.mark.parametrize('colname,ntrees,min_samples_leaf',
+                         [('a', 1, 10), ('a', 3, 5), ('b', 2, 20), ('c', 3, 50)])
+def test_discrete_slopes_match_leaf_loop(colname, ntrees, min_samples_leaf, data):
+    X, y = data()
+    _, leaves = fit_stratifier(X.drop(colname, axis=1).values, y.values, colname,
+                               ntrees=ntrees, min_samples_leaf=min_samples_leaf,
+                               bootstrap=ntrees > 1)
+    expected = loop_discrete_slopes(X, y, colname, leaves)
+    with np.errstate(all='raise'):
+        leaf_xranges, leaf_sizes, leaf_slopes, ignored = \
+            discrete_slopes(*leaf_xy_sums(leaves, X[colname].values, y.values))
+    np.testing.assert_array_equal(leaf_xranges, expected[0])
+    np.testing.assert_array_equal(leaf_sizes, expected[1])
+    np.testing.assert_allclose(leaf_slopes, expected[2], rtol=1e-9, atol=1e-9)
+    assert ignored == expected[3]
+
+
+def test_discrete_slopes_ignore_single_x_leaves():
+    # leaf 1 has a single x, equal to the last x of leaf 0, so dividing
+    # across leaf boundaries would divide by zero
+    leaf_keys = np.array([0, 0, 1, 2, 2, 2])
+    xs = np.array([1., 3., 3., 0., 1., 4.])
+    ysums = np.array([9., 8., 20., 2., 6., 10.])
+    counts = np.array([1, 1, 4, 2, 3, 2])
+    with np.errstate(all='raise'):
+        leaf_xranges, leaf_sizes, leaf_slopes, ignored = discrete_slopes(leaf_keys, xs, ysums, counts)
+    np.testing.assert_array_equal(leaf_xranges, [[1, 3], [0, 1], [1, 4]])
+    np.testing.assert_array_equal(leaf_sizes, [1, 1, 2, 3, 2])
+    np.testing.assert_allclose(leaf_slopes, [-.5, 1, 1])
+    assert ignored == 4
+
+
+@pytest.mark.parametrize('colname,ntrees,min_samples_leaf,nbins',
+                         [('a', 1, 10, 3), ('b', 1, 20, 3), ('b', 3, 30, 5), ('a', 2, 50, 1)])
+def test_point_betas_match_bin_loop(colname, ntrees, min_samples_leaf, nbins, data):
+    X, y = data()
+    _, leaves = fit_stratifier(X.drop(colname, axis=1).values, y.values, colname,
+                               ntrees=ntrees, min_samples_leaf=min_samples_leaf,
+                               bootstrap=ntrees > 1)
+    expected = loop_point_betas(X, y, colname, leaves, nbins)
+    leaf_xranges, leaf_slopes, point_betas, ignored = \
+        collect_point_betas(X, y, colname, leaves, nbins)
+    np.testing.assert_array_equal(leaf_xranges, expected[0])
+    np.testing.assert_allclose(leaf_slopes, expected[1], rtol=1e-7, atol=1e-9)
+    np.testing.assert_allclose(point_betas, expected[2], rtol=1e-7, atol=1e-9)
+    assert ignored == expected[3]
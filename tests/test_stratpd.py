@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from stratx.partdep import CatStratPD, StratPD, StratSums, window_drift
+
+
+def assert_same_curve(m:StratPD, expected):
+    pdpx, pdpy = m.curve()
+    np.testing.assert_array_equal(pdpx, expected.pdpx)
+    np.testing.assert_allclose(pdpy, expected.pdpy, rtol=1e-9, atol=1e-9)
+    assert m.ignored == expected.ignored
+
+
+@pytest.mark.parametrize('colname', ['a', 'b'])
+def test_stratpd_update_matches_from_scratch(colname, data):
+    X, y = data(n=3000)
+    A, B = slice(0, 2000), slice(2000, 3000)
+    m = StratPD(colname, ntrees=2, min_samples_leaf=10, bootstrap=True)
+    m.fit(X[A], y[A])
+    assert_same_curve(m, StratSums.from_data(m.rf, X[A], y[A], colname).stratpd())
+    m.partial_update(X[B], y[B])
+    assert_same_curve(m, StratSums.from_data(m.rf, X, y, colname).stratpd())
+    m.remove(X[:700], y[:700])
+    assert_same_curve(m, StratSums.from_data(m.rf, X[700:], y[700:], colname).stratpd())
+    assert m.n == 2300
+
+
+def test_stratpd_x_added_then_removed(data):
+    X, y = data(n=3000)
+    m = StratPD('a', min_samples_leaf=10).fit(X, y)
+    # a is 0..29 so 40 is an x value never seen by fit()
+    new = X[:200].assign(a=40)
+    m.partial_update(new, y[:200])
+    assert m.uniq_x[-1] == 40
+    assert_same_curve(m, StratSums.from_data(m.rf, pd.concat([X, new]), pd.concat([y, y[:200]]),
+                                             'a').stratpd())
+    gone = X['a'] == 15
+    m.remove(X[gone], y[gone])
+    m.remove(new, y[:200])
+    assert 15 not in m.uniq_x and 40 not in m.uniq_x
+    kept = ~gone
+    assert_same_curve(m, StratSums.from_data(m.rf, X[kept], y[kept], 'a').stratpd())
+
+
+def assert_same_deltas(m:CatStratPD, expected):
+    np.testing.assert_allclose(m.deltas.values, expected.deltas, rtol=1e-9, atol=1e-9)
+    assert list(m.deltas.index) == list(expected.catnames)
+    assert m.ignored == expected.ignored
+
+
+@pytest.mark.parametrize('use_weighted_avg', [False, True])
+def test_catstratpd_update_matches_from_scratch(use_weighted_avg, data):
+    X, y = data(n=3000)
+    A, B = slice(0, 2000), slice(2000, 3000)
+    m = CatStratPD('c', ntrees=2, min_samples_leaf=10, bootstrap=True,
+                   use_weighted_avg=use_weighted_avg)
+
+    def from_scratch(X, y):
+        sums = StratSums.from_data(m.rf, X, y, 'c', categorical=True)
+        return sums.catstratpd(use_weighted_avg=use_weighted_avg)
+
+    m.fit(X[A], y[A])
+    assert_same_deltas(m, from_scratch(X[A], y[A]))
+    m.partial_update(X[B], y[B])
+    assert_same_deltas(m, from_scratch(X, y))
+    m.remove(X[:700], y[:700])
+    assert_same_deltas(m, from_scratch(X[700:], y[700:]))
+
+
+@pytest.mark.parametrize('use_weighted_avg', [False, True])
+def test_catstratpd_category_removed(use_weighted_avg, data):
+    X, y = data(n=3000)
+    m = CatStratPD('c', use_weighted_avg=use_weighted_avg).fit(X, y)
+    gone = X['c'] == 3
+    m.remove(X[gone], y[gone])
+    deltas = m.deltas
+    assert np.isnan(deltas[3])
+    others = deltas.drop(3)
+    assert np.all(np.isfinite(others))
+    assert others.min() == 0
+
+
+def test_window_drift_matches_refit_windows(data):
+    X, y = data(n=3000)
+    batches = [(X[i:i+500], y[i:i+500]) for i in range(0, 3000, 500)]
+    m = StratPD('a', min_samples_leaf=10)
+    snapshots, distances = window_drift(m, batches, window=3)
+    assert len(snapshots) == 4 and len(distances) == 3
+    # the forest is fit to the first window and kept for the rest
+    for i, (pdpx, pdpy) in enumerate(snapshots):
+        rows = slice(500*i, 500*(i+3))
+        expected = StratSums.from_data(m.rf, X[rows], y[rows], 'a').stratpd()
+        np.testing.assert_array_equal(pdpx, expected.pdpx)
+        np.testing.assert_allclose(pdpy, expected.pdpy, rtol=1e-9, atol=1e-9)
+    assert np.all(np.isfinite(distances)) and np.all(distances > 0)
+
+
+def test_window_drift_category_leaves_window(data):
+    X, y = data(n=3000)
+    # category 3 only shows up in the first batch
+    X.loc[X.index >= 500, 'c'] = X['c'].where(X['c'] != 3, 4)
+    batches = [(X[i:i+500], y[i:i+500]) for i in range(0, 3000, 500)]
+    m = CatStratPD('c', min_samples_leaf=10)
+    snapshots, distances = window_drift(m, batches, window=2)
+    assert not np.isnan(snapshots[0][3])
+    for deltas in snapshots[1:]:
+        assert np.isnan(deltas[3])
+        assert np.all(np.isfinite(deltas.drop(3)))
+    assert np.all(np.isfinite(distances))
@@ -0,0 +1,138 @@
+from concurrent.futures import ProcessPoolExecutor
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from stratx.partdep import StratSums, fit_stratifier
+
+
+def stratifier(X, y, colname):
+    rf, _ = fit_stratifier(X.drop(colname, axis=1).values, y.values, colname,
+                           ntrees=3, min_samples_leaf=10, bootstrap=True)
+    return rf
+
+
+def shard_sums(rf, X, y, colname, categorical):
+    "Stands in for a separate machine summing its own shard"
+    return StratSums.from_data(rf, X, y, colname, categorical=categorical)
+
+
+def assert_same_sums(a:StratSums, b:StratSums):
+    assert a.colname == b.colname
+    assert a.n == b.n
+    assert a.forest == b.forest
+    np.testing.assert_array_equal(a.leaf_keys, b.leaf_keys)
+    np.testing.assert_array_equal(a.xs, b.xs)
+    np.testing.assert_array_equal(a.counts, b.counts)
+    np.testing.assert_allclose(a.ysums, b.ysums, rtol=1e-12)
+    if a.categories is None:
+        assert b.categories is None
+    else:
+        np.testing.assert_array_equal(a.categories, b.categories)
+
+
+@pytest.mark.parametrize('colname', ['a', 'b'])
+def test_merged_shards_match_single_pass(colname, data):
+    X, y = data()
+    rf = stratifier(X, y, colname)
+    whole = StratSums.from_data(rf, X, y, colname)
+    shards = [StratSums.from_data(rf, X.iloc[i:i+300], y.iloc[i:i+300], colname)
+              for i in range(0, len(X), 300)]
+    left = shards[0]
+    for s in shards[1:]:
+        left = left.merge(s)
+    right = shards[-1]
+    for s in reversed(shards[:-1]):
+        right = s.merge(right)
+    assert_same_sums(left, whole)
+    assert_same_sums(right, whole)
+
+    pd_whole, pd_merged = whole.stratpd(), left.stratpd()
+    np.testing.assert_array_equal(pd_merged.pdpx, pd_whole.pdpx)
+    np.testing.assert_allclose(pd_merged.pdpy, pd_whole.pdpy, equal_nan=True)
+    assert pd_merged.ignored == pd_whole.ignored
+
+
+def test_merged_categorical_shards_match_single_pass(data):
+    X, y = data()
+    X['c'] = pd.Categorical.from_codes(X['c'], categories=list('ABCDEFGH'))
+    rf = stratifier(X.assign(c=X['c'].cat.codes), y, 'c')
+    whole = StratSums.from_data(rf, X, y, 'c', categorical=True)
+    merged = StratSums.from_data(rf, X.iloc[:400], y.iloc[:400], 'c', categorical=True) \
+        .merge(StratSums.from_data(rf, X.iloc[400:], y.iloc[400:], 'c', categorical=True))
+    assert_same_sums(merged, whole)
+
+    cat_whole, cat_merged = whole.catstratpd(), merged.catstratpd()
+    np.testing.assert_allclose(cat_merged.avg_per_cat, cat_whole.avg_per_cat, equal_nan=True)
+    assert list(cat_merged.catnames) == list(cat_whole.catnames)
+
+
+def test_merge_across_process_pool(data):
+    X, y = data()
+    rf = stratifier(X, y, 'a')
+    starts = range(0, len(X), 250)
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        futures = [pool.submit(shard_sums, rf, X.iloc[i:i+250], y.iloc[i:i+250], 'a', False)
+                   for i in starts]
+        shards = [f.result() for f in futures]
+    merged = shards[0]
+    for s in shards[1:]:
+        merged = merged.merge(s)
+    assert_same_sums(merged, StratSums.from_data(rf, X, y, 'a'))
+
+
+def test_merge_negated_removes_rows(data):
+    X, y = data()
+    rf = stratifier(X, y, 'a')
+    first = StratSums.from_data(rf, X.iloc[:600], y.iloc[:600], 'a')
+    rest = StratSums.from_data(rf, X.iloc[600:], y.iloc[600:], 'a')
+    assert_same_sums(first.merge(rest).merge(-rest), first)
+
+
+def test_merge_rejects_other_forest(data):
+    X, y = data()
+    a = StratSums.from_data(stratifier(X, y, 'a'), X, y, 'a')
+    X2, y2 = data(seed=2)
+    b = StratSums.from_data(stratifier(X2, y2, 'a'), X2, y2, 'a')
+    with pytest.raises(ValueError):
+        a.merge(b)
+
+
+@pytest.mark.parametrize('categorical', [False, True])
+def test_save_load_round_trip(categorical, data):
+    X, y = data()
+    rf = stratifier(X, y, 'c')
+    if categorical:
+        X['c'] = pd.Categorical.from_codes(X['c'], categories=list('ABCDEFGH'))
+    sums = StratSums.from_data(rf, X, y, 'c', categorical=categorical)
+    f = io.BytesIO()
+    sums.save(f)
+    f.seek(0)
+    loaded = StratSums.load(f)
+    assert_same_sums(loaded, sums)
+    np.testing.assert_array_equal(loaded.ysums, sums.ysums)
+
+
+def test_loaded_shard_merges_with_int_column_names(data):
+    X, y = data()
+    X = pd.DataFrame(X.to_numpy()) # int column names 0, 1, 2
+    rf = stratifier(X, y, 0)
+    first = StratSums.from_data(rf, X.iloc[:600], y.iloc[:600], 0)
+    f = io.BytesIO()
+    first.save(f)
+    f.seek(0)
+    loaded = StratSums.load(f)
+    assert loaded.colname == 0 and isinstance(loaded.colname, int)
+    rest = StratSums.from_data(rf, X.iloc[600:], y.iloc[600:], 0)
+    assert_same_sums(loaded.merge(rest), StratSums.from_data(rf, X, y, 0))
+
+
+def test_save_load_without_forest():
+    sums = StratSums('x', np.array([0, 0]), np.array([1., 2.]), np.array([3., 4.]),
+                     np.array([1, 1]), n=2)
+    f = io.BytesIO()
+    sums.save(f)
+    f.seek(0)
+    assert_same_sums(StratSums.load(f), sums)